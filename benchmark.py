@@ -0,0 +1,305 @@
+"""
+Offline benchmarks of main.py and compose_emails.py against fake_google. Each scenario runs on a
+freshly generated tree, in a process of its own, and reports wall time, API calls served by the
+fake (batch sub-requests counted individually), HTTP round trips, response bytes and how much the
+scenario raised the peak memory (RSS) of its process above what the generated tree takes
+
+    python benchmark.py --files 10000 --shape balanced --latency 0.02 --workers 8
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import compose_emails
+from fake_google import FOLDER, FakeGoogle
+from main import DriveFiles, Runner, run_sharded
+from ratelimit import RateLimiter
+from templates import EmailTemplate
+
+SCENARIOS = {}
+
+
+def scenario(name):
+    def register(function):
+        SCENARIOS[name] = function
+        return function
+
+    return register
+
+
+def drive_for(fake, args, http_f=None):
+    return DriveFiles(
+        lambda: None,
+        RateLimiter(args.max_qps, max_concurrency=max(args.workers, 1)),
+        http_f=http_f or fake.http,
+    )
+
+
+# pylint: disable=too-many-arguments
+def run_runner(
+    fake, args, source, dest, move_files=False, enumerate_owners=False, copy_files=False, **options
+):
+    with tempfile.TemporaryDirectory() as tmp:
+        owners_file = os.path.join(tmp, "owners.csv") if enumerate_owners else None
+        runner = Runner(drive_for(fake, args), owners_file, workers=args.workers, **options)
+        try:
+            runner.run(source, dest, move_files, enumerate_owners, copy_files=copy_files)
+        finally:
+            runner.close()
+
+
+@contextlib.contextmanager
+def stdout_discarded():
+    """Discard what is written to file descriptor 1, e.g. by child processes, which inherit it"""
+    saved = os.dup(1)
+    try:
+        with open(os.devnull, "w", encoding="utf-8") as devnull:
+            os.dup2(devnull.fileno(), 1)
+        yield
+    finally:
+        os.dup2(saved, 1)
+        os.close(saved)
+
+
+def check_moved(fake, source):
+    """Raise an error if files are left anywhere in the source tree"""
+    left = 0
+    folders = [source]
+    while folders:
+        for child_id in fake.children.get(folders.pop(), ()):
+            if fake.files[child_id]["mimeType"] == FOLDER:
+                folders.append(child_id)
+            else:
+                left += 1
+    if left:
+        raise RuntimeError(f"{left} files were not moved out of the source")
+
+
+@scenario("traversal")
+def traversal(fake, args, source, dest):
+    """Walk the source folder by folder and mirror its folders in the destination"""
+    run_runner(fake, args, source, dest)
+
+
+@scenario("traversal-index")
+def traversal_index(fake, args, source, dest):
+    """Same as traversal, listing the whole corpus up front (--index)"""
+    run_runner(fake, args, source, dest, use_index=True)
+
+
+@scenario("traversal-depth-first")
+def traversal_depth_first(fake, args, source, dest):
+    """Same as traversal, walking depth-first with lazily listed folders (--depth-first)"""
+    run_runner(fake, args, source, dest, depth_first=True)
+
+
+@scenario("moves")
+def moves(fake, args, source, dest):
+    """Move every file, one files.update request per file"""
+    run_runner(fake, args, source, dest, move_files=True)
+    check_moved(fake, source)
+
+
+@scenario("moves-subfolder")
+def moves_subfolder(fake, args, source, dest):
+    """
+    Move the files of a source holding a single folder of --files files (in place of the generated
+    tree) with at least 4 workers: moving files while their folder is paged through would make the
+    listing skip some
+    """
+    source = fake.add("large folder source", None, FOLDER)
+    folder = fake.add("large folder", source, FOLDER)
+    fake.generate_tree(folder, args.files, shape="wide", owners=args.owners)
+    args = argparse.Namespace(**{**vars(args), "workers": max(args.workers, 4)})
+    run_runner(fake, args, source, dest, move_files=True)
+    check_moved(fake, source)
+
+
+@scenario("batch-moves")
+def batch_moves(fake, args, source, dest):
+    """Move every file with batch requests (--batch-moves)"""
+    run_runner(fake, args, source, dest, move_files=True, batch_moves=True)
+    check_moved(fake, source)
+
+
+@scenario("moves-depth-first")
+def moves_depth_first(fake, args, source, dest):
+    """Move every file while walking depth-first (--depth-first)"""
+    run_runner(fake, args, source, dest, move_files=True, depth_first=True)
+    check_moved(fake, source)
+
+
+@scenario("shards")
+def shards(fake, args, source, dest):
+    """
+    Move every file with --shards processes (main.py --shards), which reach the fake through a
+    local HTTP server. Peak memory is that of the coordinating process only
+    """
+    server = fake.serve()
+    runner = Runner(drive_for(fake, args, server.http), None, workers=args.workers)
+    try:
+        runner.set_actions(True, False)
+        with stdout_discarded():
+            run_sharded(runner, source, dest, args.shards, options={"http_f": server.http})
+    finally:
+        runner.close()
+        server.close()
+    check_moved(fake, source)
+
+
+@scenario("copies")
+def copies(fake, args, source, dest):
+    """Copy every file, then run again, which should find every copy up to date"""
+    run_runner(fake, args, source, dest, copy_files=True)
+    run_runner(fake, args, source, dest, copy_files=True)
+
+
+@scenario("owners")
+def owners(fake, args, source, dest):
+    """Enumerate owners with one permissions.list call per file"""
+    run_runner(fake, args, source, dest, enumerate_owners=True)
+
+
+@scenario("listed-owners")
+def listed_owners(fake, args, source, dest):
+    """Enumerate owners from listing data (--listed-owners)"""
+    run_runner(fake, args, source, dest, enumerate_owners=True, listed_owners=True)
+
+
+# pylint: disable=unused-argument
+@scenario("emails")
+def emails(fake, args, source, dest):
+    """Send one email per owner of the tree"""
+    links = {}
+    for item in fake.files.values():
+        for owner in item.get("owners", ()):
+            links.setdefault(owner["emailAddress"], []).append(item["webViewLink"])
+    template = EmailTemplate(
+        from_email=fake.user,
+        owner_target_email="owner-target@example.com",
+        drive_folder=source,
+        resource_key="resource-key",
+    )
+    # the fake only enforces a quota if asked to with --fake-qps
+    limiter = RateLimiter(args.max_qps * compose_emails.SEND_UNITS, max_concurrency=args.workers)
+    sender = compose_emails.Sender(
+        None, True, workers=args.workers, limiter=limiter, http_f=fake.http
+    )
+    sender.send_all((email, template.message(email, links[email])) for email in sorted(links))
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_scenario(name, args):
+    fake = FakeGoogle(latency=args.latency, qps=args.fake_qps, error_rate=args.error_rate)
+    source = fake.add("source", None, FOLDER)
+    dest = fake.add("dest", None, FOLDER, drive_id="shared-drive")
+    fake.generate_tree(
+        source,
+        args.files,
+        shape=args.shape,
+        fanout=args.fanout,
+        owners=args.owners,
+        depth=args.depth,
+    )
+    fake.calls.clear()
+    fake.http_requests = fake.bytes_sent = 0
+
+    rss_before = peak_rss()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        SCENARIOS[name](fake, args, source, dest)
+    wall_time = time.perf_counter() - start
+    peak = peak_rss() - rss_before
+
+    return {
+        "scenario": name,
+        "wall_time_s": round(wall_time, 3),
+        "api_calls": sum(count for call, count in fake.calls.items() if call != "batch"),
+        "http_requests": fake.http_requests,
+        "response_bytes": fake.bytes_sent,
+        "peak_memory_mb": round(peak / 2**20, 1),
+        "calls": dict(sorted(fake.calls.items())),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", 1)[0])
+    parser.add_argument(
+        "scenarios",
+        nargs="*",
+        help=f"Scenarios to run (default all): {', '.join(SCENARIOS)}",
+    )
+    parser.add_argument("--files", help="Files in the source tree", type=int, default=10000)
+    parser.add_argument(
+        "--shape", help="Tree shape", choices=("balanced", "wide", "deep"), default="balanced"
+    )
+    parser.add_argument(
+        "--fanout", help="Subfolders and files per balanced folder", type=int, default=10
+    )
+    parser.add_argument("--depth", help="Depth of the deep tree", type=int, default=100)
+    parser.add_argument("--owners", help="Distinct file owners", type=int, default=50)
+    parser.add_argument("--workers", help="Runner worker threads", type=int, default=1)
+    parser.add_argument("--shards", help="Processes of the shards scenario", type=int, default=2)
+    parser.add_argument(
+        "--latency", help="Seconds added to every HTTP round trip", type=float, default=0.0
+    )
+    parser.add_argument(
+        "--error-rate", help="Fraction of requests failing with a 503", type=float, default=0.0
+    )
+    parser.add_argument(
+        "--fake-qps",
+        help="Requests per second the fake serves before answering with rate limit errors",
+        type=int,
+    )
+    parser.add_argument(
+        "--max-qps", help="Client side request rate limit", type=float, default=10000
+    )
+    parser.add_argument("--json", help="Also write the results to this file as JSON")
+
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main():
+    args = parse_args()
+    results = []
+    print(
+        f"{'scenario':<22}{'wall (s)':>10}{'API calls':>11}{'HTTP reqs':>11}"
+        f"{'resp. MB':>10}{'peak MB':>9}"
+    )
+    for name in args.scenarios or SCENARIOS:
+        # a fresh interpreter per scenario, so that peak memory isn't carried over
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            result = pool.submit(run_scenario, name, args).result()
+        results.append(result)
+        print(
+            f"{name:<22}{result['wall_time_s']:>10.2f}{result['api_calls']:>11}"
+            f"{result['http_requests']:>11}{result['response_bytes'] / 2**20:>10.1f}"
+            f"{result['peak_memory_mb']:>9.1f}"
+        )
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,46 @@
 import os
 import argparse
-import base64
-from email.message import EmailMessage
 from pathlib import Path
 import csv
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from textwrap import dedent
 
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 
+from credentials import CredentialsManager, build_service
+from ledger import DRAFTED, SENT, Ledger
+from metrics import Metrics, add_metrics_arguments, metrics_from_args
+from owner_index import OwnerIndex
+from ratelimit import (
+    CONNECTION_ERRORS,
+    MAX_RETRIES,
+    RateLimiter,
+    backoff_delay,
+    is_rate_limited,
+    is_retryable,
+)
+from templates import DEFAULT_TEMPLATE, MAX_LINKS, EmailTemplate
+
 
 SCOPES = [
     "https://www.googleapis.com/auth/gmail.compose",
     "https://www.googleapis.com/auth/gmail.send",
 ]
 
+# Gmail allows 250 quota units per second per user; messages.send costs 100, drafts.create 10
+GMAIL_QUOTA_UNITS = 250
+SEND_UNITS = 100
+DRAFT_UNITS = 10
+SEND_WORKERS = 4
+# messages rendered ahead of sending, per worker
+SEND_AHEAD = 4
+
 
 def authenticate(filename_token, filename_credentials):
     """Get an auth token by running a web service at localhost and clicking through an OAuth link"""
@@ -31,135 +54,166 @@ def authenticate(filename_token, filename_credentials):
     if Path(filename_token).exists():
         creds = Credentials.from_authorized_user_file(filename_token, SCOPES)
     if not creds or not creds.valid:
-        if creds and not creds.expired and creds.refresh_token:
+        if creds and creds.expired and creds.refresh_token:
             creds.refresh(Request())
         else:
             flow = InstalledAppFlow.from_client_secrets_file(filename_credentials, scopes=SCOPES)
             creds = flow.run_local_server(open_browser=False)
-            with open(filename_token, "w", encoding="utf-8") as token:
-                token.write(creds.to_json())
+        with open(filename_token, "w", encoding="utf-8") as token:
+            token.write(creds.to_json())
     return creds
 
 
-def gmail_create_draft(
-    send_messages, from_email, to_email, owner_target_email, drive_folder, resource_key, creds
-):
-    """
-    Create and insert a draft email.
-     Print the returned draft's message and id.
-     Returns: Draft object, including draft id and message meta data.
-
-    Load pre-authorized user credentials from the environment.
-    TODO(developer) - See https://developers.google.com/identity
-    for guides on implementing OAuth2 for the application.
-    """
-
-    try:
-        # create gmail api client
-        service = build("gmail", "v1", credentials=creds)
-
-        message = EmailMessage()
-
-        html_content = f"""
-            <html>
-            <body>
-            <p>Hello,</p>
-
-            <p>You are receiving this email because you are the owner of one or more files in the NeuroPoly
-            shared GDrive folder. Since this folder is hosted on someone's personal Google Drive, <strong>we're
-            migrating all our files to a Shared Drive</strong> managed by the lab. Unfortunately, Google doesn't provide
-            a way for us to take ownership of all these files automatically, so we need your help in
-            transferring them. <strong>This should take less than 2 minutes of your time.</strong></p>
-
-            <ol>
-            <li><strong>View the files owned by you</strong> listed here:
-            https://drive.google.com/drive/u/0/folders/{drive_folder}?resourcekey={resource_key}&q=owner:{to_email}%20parent:{drive_folder}
+class Outcome:
+    """Result of mailing one recipient"""
 
-            <li><strong>Select all files</strong> (<pre style="display: inline">ctrl</pre> + A / <pre style="display: inline">⌘</pre> + A on Mac)
+    __slots__ = ("email", "status", "id", "error")
 
-            <li><strong>Open the sharing menu</strong> by pressing <pre style="display: inline">ctrl</pre> + <pre style="display: inline">alt</pre> + A (<pre style="display: inline">⌘</pre> + <pre style="display: inline">alt</pre> + A on Mac) OR right-click and select Share → Share
+    def __init__(self, email, status, id=None, error=None):  # pylint: disable=redefined-builtin
+        self.email = email
+        self.status = status
+        self.id = id
+        self.error = error
 
-            <li><strong>Add {owner_target_email} as an Editor</strong> and press "Send"
+    def __str__(self):
+        detail = self.id or self.error
+        return f"{self.email}: {self.status}" + (f" ({detail})" if detail else "")
 
-            <li><strong>Repeat steps 2-3</strong> to bring up the Sharing dialog again
 
-            <li><strong>Find {owner_target_email} in the list</strong> click the dropdown next to "Editor", then click Transfer Ownership.
-
-            <li><strong>Confirm ownership transfer</strong>. That's it; you're done!
-            </ol>
+# pylint: disable=missing-function-docstring
+class Sender:
+    """
+    Sends or drafts messages from a pool of `workers` threads, each with its own Gmail service
+    built once. Requests are throttled to Gmail's per-user quota (GMAIL_QUOTA_UNITS per second,
+    a send costing SEND_UNITS and a draft DRAFT_UNITS) and at most `daily_limit` messages are
+    sent; transient errors are retried with backoff. A send whose connection drops is reported
+    as "uncertain" rather than retried, as Gmail may have sent it. Outcomes are recorded in
+    `ledger` if given
+    """
 
-            <p>Thanks so much for taking the time to do this. It saves us a lot of trouble and means our files can
-            keep their editing history and comments. If you have any issues in the transfer process, <strong>don't
-            hesitate to reach out</strong>! If you're on our Slack, ping IT staff there; otherwise you can
-            email neuropoly-admin@liste.polymtl.ca</p>
-            <p>Best,</p>
-            <p>The NeuroPoly IT team</p>
-        </body>
-        </html>
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        creds,
+        send_messages,
+        workers=SEND_WORKERS,
+        daily_limit=None,
+        limiter=None,
+        metrics=None,
+        http_f=None,
+        ledger=None,
+    ):
+        self.creds = creds
+        self.send_messages = send_messages
+        self.workers = workers
+        self.daily_limit = daily_limit
+        self.metrics = metrics or Metrics()
+        # optional function of the credentials returning the transport, as for main.DriveFiles
+        self.http_f = http_f
+        # optional ledger.Ledger recording each recipient's outcome as soon as it is known
+        self.ledger = ledger
+        self.limiter = limiter or RateLimiter(GMAIL_QUOTA_UNITS, max_concurrency=workers)
+        self.lock = threading.Lock()
+        self.sent = 0
+        self._local = threading.local()
+
+    @property
+    def service(self):
+        """This thread's Gmail service"""
+        service = getattr(self._local, "service", None)
+        if service is None:
+            http = self.http_f(self.creds) if self.http_f else None
+            service = build_service("gmail", "v1", self.creds, http)
+            self._local.service = service
+        return service
+
+    def _reserve(self):
+        """Count a message against the daily limit, returning False if it's reached"""
+        if not self.send_messages:
+            return True
+        with self.lock:
+            if self.daily_limit is not None and self.sent >= self.daily_limit:
+                return False
+            self.sent += 1
+            return True
+
+    def _request(self, raw):
+        # pylint: disable=no-member
+        messages = self.service.users()
+        if self.send_messages:
+            return messages.messages().send(userId="me", body={"raw": raw}), SEND_UNITS
+        return messages.drafts().create(userId="me", body={"message": {"raw": raw}}), DRAFT_UNITS
+
+    def send(self, email, raw):
+        """Send or draft `raw` (an EmailTemplate.message) to `email`, returning an Outcome"""
+        if not self._reserve():
+            return Outcome(email, "skipped", error="daily sending limit reached")
+
+        if self.ledger:
+            self.ledger.start(email)
+        outcome = self._deliver(email, raw)
+        # an uncertain send stays "sending" in the ledger, for --resend-uncertain to decide
+        if self.ledger and outcome.status != "uncertain":
+            self.ledger.finish(outcome)
+        return outcome
+
+    def _undo_reserve(self):
+        if self.send_messages:
+            with self.lock:
+                self.sent -= 1
+
+    def _deliver(self, email, raw):
+        attempt = 0
+        while True:
+            request, units = self._request(raw)
+            self.limiter.acquire(units)
+            throttled = False
+            try:
+                response = self.metrics.execute(request)
+                return Outcome(email, "sent" if self.send_messages else "drafted", response["id"])
+            except HttpError as e:
+                if attempt == MAX_RETRIES or not is_retryable(e):
+                    self._undo_reserve()
+                    return Outcome(email, "failed", error=str(e))
+                throttled = is_rate_limited(e)
+                delay = backoff_delay(attempt, e)
+            except CONNECTION_ERRORS as e:
+                # this thread's service is rebuilt on a fresh connection
+                self._local.service = None
+                if self.send_messages:
+                    # Gmail may have sent the message already: sending it again could mail twice
+                    return Outcome(email, "uncertain", error=f"connection lost: {e}")
+                if attempt == MAX_RETRIES:
+                    return Outcome(email, "failed", error=str(e))
+                delay = backoff_delay(attempt)
+            finally:
+                self.limiter.release(throttled)
+            self.metrics.retry(request.methodId)
+            time.sleep(delay)
+            attempt += 1
+
+    def send_all(self, messages):
         """
-
-        plain_content = f"""
-            Hello,
-
-            You are receiving this email because you are the owner of one or more files in the NeuroPoly
-            shared GDrive folder. Since this folder is hosted on someone's personal Google Drive, **we're
-            migrating all our files to a Shared Drive** managed by the lab. Unfortunately, Google doesn't provide
-            a way for us to take ownership of all these files automatically, so we need your help in
-            transferring them. **This should take less than 2 minutes of your time.**
-
-
-            1. View the files owned by you listed here:
-            https://drive.google.com/drive/u/0/folders/{drive_folder}?resourcekey={resource_key}&q=owner:{to_email}%20parent:{drive_folder}
-
-            2. Select all files (ctrl + A / ⌘ + A on Mac)
-
-            3. Open the sharing menu by pressing ctrl + alt + A (⌘ + alt + A on Mac) OR right-click and select Share → Share
-
-            4. Add {owner_target_email} as an Editor and press "Send"
-
-            5. Repeat steps 2-3 to bring up the Sharing dialog again
-
-            6. Find {owner_target_email} in the list click the dropdown next to "Editor", then click Transfer Ownership.
-
-            7. Confirm ownership transfer. That's it; you're done!
-
-            Thanks so much for taking the time to do this. It saves us a lot of trouble and means our files can
-            keep their editing history and comments. If you have any issues in the transfer process, don't
-            hesitate to reach out! If you're on our Slack, ping IT staff there; otherwise you can email
-            neuropoly-admin@liste.polymtl.ca .
-
-            Best,
-            The NeuroPoly IT team
+        Send each (email, raw) of `messages` concurrently, printing outcomes as they come. Returns
+        the outcomes in the order of `messages`, which is consumed lazily: only a few messages per
+        worker are rendered ahead of sending
         """
+        outcomes = []
+        in_flight = {}
 
-        message.set_content(plain_content)
-        message.add_alternative(html_content, subtype="html")
-        message["To"] = to_email
-        message["From"] = from_email
-        message["Subject"] = "[Action Required] NeuroPoly Drive Migration Notice"
-
-        # encoded message
-        encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-
-        # pylint: disable=E1101
-        if send_messages:
-            create_message = {"raw": encoded_message}
-            send_message = (
-                service.users().messages().send(userId="me", body=create_message).execute()
-            )
-            print(f'Message Id: {send_message["id"]}')
-            return
+        def collect(futures):
+            for future in futures:
+                outcomes[in_flight.pop(future)] = future.result()
+                print(future.result())
 
-        create_message = {"message": {"raw": encoded_message}}
-        draft = service.users().drafts().create(userId="me", body=create_message).execute()
-
-        print(f'Draft id: {draft["id"]}\nDraft message: {draft["message"]}')
-
-    except HttpError as error:
-        print(f"An error occurred: {error}")
-        draft = None
-
-    return draft
+        with ThreadPoolExecutor(self.workers) as pool:
+            for email, raw in messages:
+                if len(in_flight) >= SEND_AHEAD * self.workers:
+                    collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+                in_flight[pool.submit(self.send, email, raw)] = len(outcomes)
+                outcomes.append(None)
+            collect(as_completed(list(in_flight)))
+        return outcomes
 
 
 def parse_args():
@@ -180,9 +234,13 @@ def parse_args():
     parser.add_argument(
         "-o",
         "--owners-file",
-        help="CSV for storing list of owners (can run long)",
+        help="Owners CSV written by main.py -o, to read instead of --owner-index",
         type=argparse.FileType("r"),
-        default="owners.csv",
+    )
+    parser.add_argument(
+        "--owner-index",
+        help="Owner index written by main.py --list-owners (default ./owners.db)",
+        default=os.path.join(os.getcwd(), "owners.db"),
     )
 
     parser.add_argument("-f", "--from-email", help="Email to send from", required=True)
@@ -203,6 +261,51 @@ def parse_args():
         "--send-messages",
         help="Set to 'send' to send emails rather than creating a draft. All other values will fail",
     )
+    parser.add_argument(
+        "--template",
+        help=(
+            "Path, without extension, of the .txt and .html email templates"
+            " (default email_templates/migration_notice)"
+        ),
+        default=DEFAULT_TEMPLATE,
+    )
+    parser.add_argument(
+        "--workers",
+        help=f"Number of threads sending messages concurrently (default {SEND_WORKERS})",
+        type=int,
+        default=SEND_WORKERS,
+    )
+    parser.add_argument(
+        "--daily-limit",
+        help=(
+            "Stop after sending this many messages, e.g. 2000 for Google Workspace accounts or 500"
+            " for consumer accounts, minus what was already sent today"
+        ),
+        type=int,
+    )
+    parser.add_argument(
+        "--ledger",
+        help=(
+            "SQLite file recording who was mailed, so that re-runs only mail new recipients and"
+            " those which failed (default ./email_ledger.db)"
+        ),
+        default=os.path.join(os.getcwd(), "email_ledger.db"),
+    )
+    parser.add_argument(
+        "--campaign",
+        help="Name under which to record messages in --ledger (default the --drive-folder ID)",
+    )
+    parser.add_argument(
+        "--resend-uncertain",
+        help="Mail again recipients whose message was being sent when a previous run was interrupted",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--report",
+        help="CSV file in which to write the outcome for each recipient",
+        type=argparse.FileType("w"),
+    )
+    add_metrics_arguments(parser)
 
     return parser.parse_args()
 
@@ -217,28 +320,82 @@ def main():
     send_messages = args.send_messages and args.send_messages.lower() == "send"
 
     user_credentials = os.path.join(os.getcwd(), "token.json")
-    creds = authenticate(user_credentials, args.app_credentials.name)
-
-    counts = {}
-    with open(args.owners_file.name, "r", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            email = row["Email"]
-            if email not in counts:
-                counts[email] = 0
-
-            counts[email] += 1
-
-    for email in counts:
-        gmail_create_draft(
-            send_messages,
-            args.from_email,
-            email,
-            args.owner_target_email,
-            args.drive_folder,
-            args.resource_key,
-            creds,
+    credentials = CredentialsManager(
+        authenticate(user_credentials, args.app_credentials.name), user_credentials
+    ).start()
+    api_metrics = metrics_from_args(args)
+
+    links = {}
+    if args.owners_file:
+        with args.owners_file as f:
+            # owners files written by earlier versions of main.py have ", " between fields
+            reader = csv.DictReader(f, skipinitialspace=True)
+            for row in reader:
+                links.setdefault(row["Email"], []).append(row["File link"])
+        owner_index = None
+        counts = [(email, len(email_links)) for email, email_links in links.items()]
+    elif Path(args.owner_index).exists():
+        owner_index = OwnerIndex(args.owner_index)
+        counts = owner_index.counts()
+    else:
+        print(f"{args.owner_index} not found: run main.py --list-owners first, or pass -o")
+        return
+
+    def owner_links(email):
+        if owner_index:
+            return owner_index.links(email, MAX_LINKS)
+        return links[email][:MAX_LINKS]
+
+    template = EmailTemplate(
+        args.template,
+        args.from_email,
+        owner_target_email=args.owner_target_email,
+        drive_folder=args.drive_folder,
+        resource_key=args.resource_key,
+    )
+    ledger = Ledger(args.ledger, args.campaign or args.drive_folder)
+    statuses = ledger.statuses()
+    done = SENT if send_messages else DRAFTED
+    outcomes = []
+    recipients = []
+    for email, count in counts:
+        status = statuses.get(email)
+        if status in done:
+            outcomes.append(Outcome(email, f"already {status}"))
+        elif status == "sending" and not args.resend_uncertain:
+            # interrupted while sending: Gmail may or may not have the message
+            outcomes.append(Outcome(email, "uncertain", error="see --resend-uncertain"))
+        else:
+            recipients.append((email, count))
+    if outcomes:
+        print(f"Skipping {len(outcomes)} recipients already handled according to {args.ledger}")
+
+    sender = Sender(
+        credentials.credentials(),
+        send_messages,
+        args.workers,
+        args.daily_limit,
+        metrics=api_metrics,
+        ledger=ledger,
+    )
+    try:
+        outcomes += sender.send_all(
+            (email, template.message(email, owner_links(email), count))
+            for email, count in recipients
         )
+    finally:
+        credentials.stop()
+        ledger.close()
+        if owner_index:
+            owner_index.close()
+
+    if args.report:
+        with args.report as f:
+            writer = csv.writer(f)
+            writer.writerow(("Email", "Status", "Id", "Error"))
+            writer.writerows((o.email, o.status, o.id, o.error) for o in outcomes)
+    summary = Counter(outcome.status for outcome in outcomes)
+    print(", ".join(f"{count} {status}" for status, count in summary.items()))
 
 
 if __name__ == "__main__":
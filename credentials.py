@@ -0,0 +1,114 @@
+"""
+Credentials shared by all the service objects of a run and refreshed before they expire, and
+services built from the discovery documents bundled with googleapiclient, read once per process
+"""
+
+import functools
+import threading
+from datetime import datetime, timezone
+
+from google.auth.exceptions import RefreshError, TransportError
+from google.auth.transport.requests import Request
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
+
+# refresh access tokens this many seconds before they expire (google-auth itself only refreshes
+# in the last few minutes, from whichever request thread gets there first)
+REFRESH_MARGIN = 300
+# wait this long (seconds) before trying again after a failed refresh
+RETRY_DELAY = 30
+
+
+@functools.lru_cache(maxsize=None)
+def discovery_document(service_name, version):
+    """Return the JSON discovery document of an API, read from googleapiclient's static copy once"""
+    document = discovery_cache.get_static_doc(service_name, version)
+    if document is None:
+        raise ValueError(f"No discovery document for {service_name} {version}")
+    return document
+
+
+def build_service(service_name, version, creds=None, http=None):
+    """
+    Same as googleapiclient.discovery.build(service_name, version, credentials=creds, http=http),
+    without looking up and reading the discovery document every time
+    """
+    document = discovery_document(service_name, version)
+    if http is not None:
+        return build_from_document(document, http=http)
+    return build_from_document(document, credentials=creds)
+
+
+def _utcnow():
+    # google-auth keeps expiry as a naive UTC datetime
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class CredentialsManager:
+    """
+    Holds the credentials used by every service object of a run. Once started, a daemon thread
+    refreshes the access token `margin` seconds before it expires and saves it to `filename_token`,
+    so requests neither wait for a refresh nor fail on an expired token. `creds` may be None, e.g.
+    when running against fake_google, in which case there is nothing to refresh
+    """
+
+    def __init__(self, creds, filename_token=None, margin=REFRESH_MARGIN):
+        self.creds = creds
+        self.filename_token = filename_token
+        self.margin = margin
+        self.lock = threading.Lock()
+        self.refreshes = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def credentials(self):
+        """Return the shared credentials, refreshing them first if they are no longer valid"""
+        with self.lock:
+            if self.creds is not None and not self.creds.valid:
+                self._refresh()
+            return self.creds
+
+    def _refresh(self):
+        self.creds.refresh(Request())
+        self.refreshes += 1
+        if self.filename_token:
+            with open(self.filename_token, "w", encoding="utf-8") as token:
+                token.write(self.creds.to_json())
+
+    def refresh(self):
+        with self.lock:
+            self._refresh()
+
+    def expires_in(self):
+        """Return the number of seconds the access token remains valid, None if unknown"""
+        if self.creds is None or self.creds.expiry is None:
+            return None
+        return (self.creds.expiry - _utcnow()).total_seconds()
+
+    def _run(self):
+        while True:
+            expires_in = self.expires_in()
+            # without an expiry, refresh at once to learn it
+            wait = 0 if expires_in is None else max(expires_in - self.margin, 0)
+            if self._stop.wait(wait):
+                return
+            try:
+                self.refresh()
+            except (RefreshError, TransportError) as e:
+                print(f"Could not refresh the access token, retrying in {RETRY_DELAY}s: {e}")
+                if self._stop.wait(RETRY_DELAY):
+                    return
+
+    def start(self):
+        """Start refreshing in the background, if the credentials can be refreshed"""
+        if self.creds is None or not getattr(self.creds, "refresh_token", None):
+            return self
+        self._thread = threading.Thread(target=self._run, name="credentials", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,570 @@
+"""
+In-process stand-in for the parts of the Drive v3 and Gmail v1 APIs used by main.py and
+compose_emails.py. FakeGoogle holds the state; FakeHttp is an httplib2.Http look-alike which can be
+handed to googleapiclient's build(), so the real client code (request building, batching, JSON
+decoding) runs unchanged against it. FakeServer serves a FakeGoogle over HTTP on localhost, for
+clients in other processes (e.g. main.py --shards)
+"""
+
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from collections import Counter, defaultdict
+from email.parser import Parser
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httplib2
+
+FOLDER = "application/vnd.google-apps.folder"
+SHORTCUT = "application/vnd.google-apps.shortcut"
+DOC = "application/vnd.google-apps.document"
+
+DRIVE_PREFIX = "/drive/v3/"
+GMAIL_PREFIX = "/gmail/v1/users/"
+BATCH_PATHS = ("/batch/drive/v3", "/batch")
+# what googleapiclient sends requests to
+API_ROOT = "https://www.googleapis.com"
+
+
+class FakeError(Exception):
+    """Raised inside a handler to produce an HTTP error response"""
+
+    def __init__(self, status, message, reason=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.reason = reason
+
+    def body(self):
+        error = {"code": self.status, "message": self.message}
+        if self.reason:
+            error["errors"] = [
+                {"domain": "usageLimits", "reason": self.reason, "message": self.message}
+            ]
+        return {"error": error}
+
+
+def parse_fields(fields):
+    """Parse a partial response selector such as 'nextPageToken, files(id,name)' into a dict tree"""
+    tree = {}
+    stack = [tree]
+    name = ""
+    for char in fields or "":
+        if char in ",()":
+            if name.strip():
+                stack[-1][name.strip()] = {}
+            if char == "(":
+                stack.append(stack[-1][name.strip()])
+            elif char == ")":
+                stack.pop()
+            name = ""
+        else:
+            name += char
+    if name.strip():
+        stack[-1][name.strip()] = {}
+    return tree
+
+
+def project(value, tree):
+    """Keep only the fields of `value` selected by `tree`"""
+    if not tree or "*" in tree:
+        return value
+    if isinstance(value, list):
+        return [project(v, tree) for v in value]
+    if not isinstance(value, dict):
+        return value
+    return {key: project(value[key], sub) for key, sub in tree.items() if key in value}
+
+
+QUERY_TERM = re.compile(
+    r"""\s*(?:(?P<value>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")\s+in\s+(?P<in_field>\w+)"""
+    r"""|(?P<field>\w+)\s*(?P<op>!=|=)\s*(?P<rhs>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|true|false))\s*"""
+)
+
+
+def _unquote(literal):
+    if literal in ("true", "false"):
+        return literal == "true"
+    return re.sub(r"\\(.)", r"\1", literal[1:-1])
+
+
+def parse_query(q):
+    """Compile the subset of the Drive query language used by the tools into a predicate"""
+    terms = []
+    for clause in re.split(r"\s+and\s+", q.strip()) if q else []:
+        match = QUERY_TERM.fullmatch(clause)
+        if not match:
+            raise FakeError(400, f"Invalid Value: unsupported query clause {clause!r}")
+        if match["in_field"]:
+            terms.append((match["in_field"], "in", _unquote(match["value"])))
+        else:
+            terms.append((match["field"], match["op"], _unquote(match["rhs"])))
+
+    def predicate(item):
+        for field, op, value in terms:
+            if op == "in":
+                if value not in item.get(field, []):
+                    return False
+            elif (item.get(field) == value) != (op == "="):
+                return False
+        return True
+
+    predicate.parents = [value for field, op, value in terms if op == "in" and field == "parents"]
+    return predicate
+
+
+class FakeGoogle:
+    """
+    State of a fake Google account: a Drive file tree, a changes log and sent Gmail messages. All
+    handlers run under a single lock so the backend can be shared by many workers
+    """
+
+    def __init__(self, latency=0.0, qps=None, error_rate=0.0, seed=0, user="me@example.com"):
+        self.latency = latency
+        self.qps = qps
+        self.error_rate = error_rate
+        self.user = user
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.files = {}
+        self.children = defaultdict(dict)
+        self.no_permission = set()
+        self.changes = []
+        self.messages = []
+        self.drafts = []
+        self.calls = Counter()
+        self.http_requests = 0
+        self.bytes_sent = 0
+        self._ids = itertools.count()
+        self._window = (0.0, 0)
+
+    # --- tree construction --------------------------------------------------------------------
+
+    def new_id(self):
+        return f"f{next(self._ids):07d}"
+
+    def add(self, name, parent=None, mime_type="text/plain", owner=None, drive_id=None, **extra):
+        """Add a file or folder without going through the API; returns its id"""
+        file_id = extra.pop("id", None) or self.new_id()
+        owner = owner or self.user
+        item = {
+            "kind": "drive#file",
+            "id": file_id,
+            "name": name,
+            "mimeType": mime_type,
+            "parents": [parent] if parent else [],
+            "trashed": False,
+            "modifiedTime": "2024-01-01T00:00:00.000Z",
+            "webViewLink": f"https://drive.google.com/open?id={file_id}",
+            "capabilities": {"canEdit": True, "canMoveItemWithinDrive": True},
+            "thumbnailLink": f"https://lh3.googleusercontent.com/{file_id}=s220",
+            "iconLink": f"https://drive-thirdparty.googleusercontent.com/16/type/{mime_type}",
+            "permissionIds": [owner],
+            **extra,
+        }
+        if drive_id:
+            item["driveId"] = drive_id
+        else:
+            item["owners"] = [{"kind": "drive#user", "emailAddress": owner, "displayName": owner}]
+        if mime_type not in (FOLDER, SHORTCUT, DOC):
+            size = extra.get("size", str(len(name) * 100))
+            item["size"] = size
+            item["md5Checksum"] = extra.get(
+                "md5Checksum", md5(f"{name}{size}".encode()).hexdigest()
+            )
+        with self.lock:
+            self._store(item)
+        return file_id
+
+    def _store(self, item):
+        self.files[item["id"]] = item
+        for parent in item["parents"]:
+            self.children[parent][item["id"]] = None
+        self.changes.append(item["id"])
+
+    def _set_parents(self, item, parents):
+        for parent in item["parents"]:
+            self.children[parent].pop(item["id"], None)
+        item["parents"] = parents
+        for parent in parents:
+            self.children[parent][item["id"]] = None
+        self.changes.append(item["id"])
+
+    def generate_tree(self, root, files=1000, shape="balanced", fanout=10, owners=5, depth=None):
+        """
+        Fill `root` with `files` files spread over folders. shape is one of:
+        - "wide": every file directly under `root`
+        - "deep": a single chain of `depth` (default 100) nested folders, files spread along it
+        - "balanced": folders with `fanout` subfolders each, `fanout` files per folder
+        Owners are drawn from `owners` synthetic addresses; returns the list of folder ids
+        """
+        rng = self.random
+        emails = [f"owner{i}@example.com" for i in range(owners)]
+        folders = [root]
+        if shape == "deep":
+            parent = root
+            for level in range(depth or 100):
+                parent = self.add(f"level {level}", parent, FOLDER)
+                folders.append(parent)
+        elif shape == "balanced":
+            frontier = [root]
+            needed = max(files // fanout, 1)
+            while len(folders) < needed:
+                parent = frontier.pop(0)
+                for i in range(fanout):
+                    folder = self.add(f"folder {len(folders)} '{i}'", parent, FOLDER)
+                    folders.append(folder)
+                    frontier.append(folder)
+        elif shape != "wide":
+            raise ValueError(f"Unknown tree shape {shape}")
+
+        for i in range(files):
+            parent = folders[i % len(folders)] if shape != "wide" else root
+            self.add(f"file {i}.txt", parent, owner=rng.choice(emails))
+        return folders
+
+    def deny(self, file_id):
+        """Make permissions.list fail with insufficient permissions for `file_id`"""
+        self.no_permission.add(file_id)
+
+    # --- HTTP entry point ---------------------------------------------------------------------
+
+    # pylint: disable=unused-argument
+    def http(self, credentials=None):
+        """Return a transport for build(http=...); usable as DriveFiles' http_f"""
+        return FakeHttp(self)
+
+    def serve(self):
+        """Start serving this backend on localhost; returns the FakeServer, to be closed"""
+        return FakeServer(self)
+
+    def handle(self, method, uri, body):
+        """Serve one (non batch) request, returning (status, payload dict)"""
+        parsed = urllib.parse.urlparse(uri)
+        params = {k: v[-1] for k, v in urllib.parse.parse_qs(parsed.query).items()}
+        path = urllib.parse.unquote(parsed.path)
+        data = json.loads(body) if body else {}
+        try:
+            self._throttle(path)
+            if path.startswith(DRIVE_PREFIX):
+                name, result = self._drive(method, path[len(DRIVE_PREFIX) :], params, data)
+            elif path.startswith(GMAIL_PREFIX):
+                name, result = self._gmail(method, path[len(GMAIL_PREFIX) :], data)
+            else:
+                raise FakeError(404, f"Not found: {path}")
+            self.calls[name] += 1
+            return 200, project(result, parse_fields(params.get("fields")))
+        except FakeError as e:
+            self.calls["error"] += 1
+            return e.status, e.body()
+
+    def _throttle(self, path):
+        if self.error_rate and self.random.random() < self.error_rate:
+            raise FakeError(503, "Backend Error")
+        if not self.qps:
+            return
+        now = time.monotonic()
+        start, count = self._window
+        if now - start >= 1:
+            start, count = now, 0
+        self._window = (start, count + 1)
+        if count >= self.qps:
+            if path.startswith(GMAIL_PREFIX):
+                raise FakeError(429, "Too many concurrent requests for user", "rateLimitExceeded")
+            raise FakeError(403, "User rate limit exceeded.", "userRateLimitExceeded")
+
+    # --- Drive --------------------------------------------------------------------------------
+
+    def _get(self, file_id):
+        try:
+            return self.files[file_id]
+        except KeyError:
+            raise FakeError(404, f"File not found: {file_id}.") from None
+
+    def _drive(self, method, path, params, data):
+        parts = path.split("/")
+        if parts == ["files"] and method == "GET":
+            return "files.list", self._list(params)
+        if parts == ["files"] and method == "POST":
+            return "files.create", self._create(data)
+        if parts == ["files", "generateIds"]:
+            count = int(params.get("count", 10))
+            ids = [self.new_id() for _ in range(count)]
+            return "files.generateIds", {"kind": "drive#generatedIds", "ids": ids}
+        if parts[0] == "files" and len(parts) == 2 and method == "GET":
+            return "files.get", self._get(parts[1])
+        if parts[0] == "files" and len(parts) == 2 and method == "PATCH":
+            return "files.update", self._update(parts[1], params, data)
+        if parts[0] == "files" and parts[2:] == ["copy"]:
+            return "files.copy", self._copy(parts[1], data)
+        if parts[0] == "files" and parts[2:] == ["permissions"]:
+            return "permissions.list", self._permissions(parts[1])
+        if parts == ["changes", "startPageToken"]:
+            return "changes.getStartPageToken", {"startPageToken": str(len(self.changes))}
+        if parts == ["changes"]:
+            return "changes.list", self._changes(params)
+        raise FakeError(404, f"Unsupported Drive call {method} {path}")
+
+    def _list(self, params):
+        predicate = parse_query(params.get("q", ""))
+        if predicate.parents:
+            candidates = [self.files[i] for i in self.children.get(predicate.parents[0], ())]
+        else:
+            drive_id = params.get("driveId")
+            candidates = [
+                item
+                for item in self.files.values()
+                if not drive_id or item.get("driveId") == drive_id
+            ]
+        matches = [item for item in candidates if predicate(item)]
+        page_size = int(params.get("pageSize", 100))
+        offset = int(params.get("pageToken") or 0)
+        result = {"kind": "drive#fileList", "files": matches[offset : offset + page_size]}
+        if offset + page_size < len(matches):
+            result["nextPageToken"] = str(offset + page_size)
+        return result
+
+    def _create(self, data):
+        item = dict(data)
+        parents = item.pop("parents", [])
+        file_id = item.pop("id", None) or self.new_id()
+        if file_id in self.files:
+            raise FakeError(409, "A file already exists with the provided ID.")
+        item.setdefault("mimeType", "text/plain")
+        owner = None if any(self.files.get(p, {}).get("driveId") for p in parents) else self.user
+        drive_id = next(
+            (self.files[p]["driveId"] for p in parents if self.files.get(p, {}).get("driveId")),
+            None,
+        )
+        new = {
+            "kind": "drive#file",
+            "id": file_id,
+            "parents": parents,
+            "trashed": False,
+            "modifiedTime": "2024-01-01T00:00:00.000Z",
+            "webViewLink": f"https://drive.google.com/open?id={file_id}",
+            **item,
+        }
+        if owner:
+            new["owners"] = [{"kind": "drive#user", "emailAddress": owner}]
+        if drive_id:
+            new["driveId"] = drive_id
+        self._store(new)
+        return new
+
+    def _update(self, file_id, params, data):
+        item = self._get(file_id)
+        parents = list(item["parents"])
+        for removed in filter(None, params.get("removeParents", "").split(",")):
+            if removed in parents:
+                parents.remove(removed)
+        for added in filter(None, params.get("addParents", "").split(",")):
+            self._get(added)
+            parents.append(added)
+        if parents != item["parents"]:
+            self._set_parents(item, parents)
+        if data:
+            item.update(data)
+            self.changes.append(file_id)
+        return item
+
+    def _copy(self, file_id, data):
+        source = self._get(file_id)
+        if source["mimeType"] in (FOLDER, SHORTCUT):
+            raise FakeError(403, "This file cannot be copied by the user.", "cannotCopyFile")
+        copy = {
+            **{k: v for k, v in source.items() if k not in ("id", "owners", "driveId")},
+            **data,
+        }
+        return self._create(copy)
+
+    def _permissions(self, file_id):
+        item = self._get(file_id)
+        if file_id in self.no_permission:
+            raise FakeError(403, "The user does not have sufficient permissions for this file.")
+        permissions = [
+            {"kind": "drive#permission", "emailAddress": o["emailAddress"], "role": "owner"}
+            for o in item.get("owners", [])
+        ]
+        if "driveId" in item:
+            permissions.append(
+                {
+                    "kind": "drive#permission",
+                    "emailAddress": "admin@example.com",
+                    "role": "organizer",
+                }
+            )
+        permissions.append(
+            {"kind": "drive#permission", "emailAddress": self.user, "role": "writer"}
+        )
+        return {"kind": "drive#permissionList", "permissions": permissions}
+
+    def _changes(self, params):
+        start = int(params["pageToken"])
+        page_size = int(params.get("pageSize", 100))
+        changed = self.changes[start : start + page_size]
+        result = {
+            "kind": "drive#changeList",
+            "changes": [
+                {
+                    "kind": "drive#change",
+                    "changeType": "file",
+                    "fileId": file_id,
+                    "removed": False,
+                    "file": self.files[file_id],
+                }
+                for file_id in dict.fromkeys(changed)
+            ],
+        }
+        if start + page_size < len(self.changes):
+            result["nextPageToken"] = str(start + page_size)
+        else:
+            result["newStartPageToken"] = str(len(self.changes))
+        return result
+
+    # --- Gmail --------------------------------------------------------------------------------
+
+    def _gmail(self, method, path, data):
+        parts = path.split("/")
+        if method == "POST" and parts[1:] == ["messages", "send"]:
+            message = {"id": f"m{len(self.messages)}", "threadId": f"t{len(self.messages)}"}
+            self.messages.append((message["id"], data["raw"]))
+            return "messages.send", {**message, "labelIds": ["SENT"]}
+        if method == "POST" and parts[1:] == ["drafts"]:
+            draft = {"id": f"r{len(self.drafts)}", "message": {"id": f"d{len(self.drafts)}"}}
+            self.drafts.append((draft["id"], data["message"]["raw"]))
+            return "drafts.create", draft
+        raise FakeError(404, f"Unsupported Gmail call {method} {path}")
+
+
+class FakeHttp:
+    """httplib2.Http compatible transport serving requests from a FakeGoogle"""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    # pylint: disable=unused-argument
+    def request(
+        self, uri, method="GET", body=None, headers=None, redirections=5, connection_type=None
+    ):
+        backend = self.backend
+        if backend.latency:
+            time.sleep(backend.latency)
+        if isinstance(body, bytes):
+            body = body.decode("utf-8")
+
+        with backend.lock:
+            backend.http_requests += 1
+            if urllib.parse.urlparse(uri).path in BATCH_PATHS:
+                return self._batch(body, headers or {})
+            status, payload = backend.handle(method, uri, body)
+
+        content = json.dumps(payload).encode("utf-8")
+        backend.bytes_sent += len(content)
+        return _response(status, "application/json"), content
+
+    def _batch(self, body, headers):
+        backend = self.backend
+        message = Parser().parsestr(f"content-type: {headers['content-type']}\r\n\r\n{body}")
+        if len(message.get_payload()) > 100:
+            content = json.dumps(FakeError(400, "Too many requests in batch").body()).encode()
+            return _response(400, "application/json"), content
+
+        boundary = "batch_fake_boundary"
+        parts = []
+        for part in message.get_payload():
+            request = part.get_payload()
+            request_line, rest = request.split("\n", 1)
+            method, uri, _ = request_line.split(" ", 2)
+            inner_body = rest.split("\n\n", 1)[1] if "\n\n" in rest else ""
+            status, payload = backend.handle(method, uri, inner_body or None)
+            content_id = part["Content-ID"].replace("<", "<response-", 1)
+            parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: {content_id}\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                f"Content-Type: application/json; charset=UTF-8\r\n\r\n{json.dumps(payload)}\r\n"
+            )
+        content = ("".join(parts) + f"--{boundary}--\r\n").encode("utf-8")
+        backend.bytes_sent += len(content)
+        backend.calls["batch"] += 1
+        return _response(200, f"multipart/mixed; boundary={boundary}"), content
+
+
+def _response(status, content_type):
+    return httplib2.Response({"status": str(status), "content-type": content_type})
+
+
+class FakeServer:
+    """
+    Serves a FakeGoogle over HTTP on a free localhost port, from a thread per connection. Its
+    `http` can be pickled, so processes started with spawn can use it as DriveFiles' http_f
+    """
+
+    def __init__(self, backend):
+        transport = FakeHttp(backend)
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body are written separately: don't let each response wait for an ACK
+            disable_nagle_algorithm = True
+
+            # pylint: disable=invalid-name
+            def do_request(self):
+                length = int(self.headers.get("content-length") or 0)
+                body = self.rfile.read(length) if length else None
+                headers = {key.lower(): value for key, value in self.headers.items()}
+                response, content = transport.request(
+                    API_ROOT + self.path, self.command, body, headers
+                )
+                self.send_response(response.status)
+                self.send_header("content-type", response["content-type"])
+                self.send_header("content-length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = do_request
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self.http = RemoteHttp(self.url)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class RemoteHttp:
+    """
+    httplib2.Http compatible transport sending the requests meant for Google to a FakeServer at
+    `url`. Calling it returns a new one, so it is usable as DriveFiles' http_f
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self._http = None
+
+    def __call__(self, credentials=None):
+        return RemoteHttp(self.url)
+
+    def __getstate__(self):
+        return {"url": self.url, "_http": None}
+
+    # pylint: disable=unused-argument
+    def request(
+        self, uri, method="GET", body=None, headers=None, redirections=5, connection_type=None
+    ):
+        if self._http is None:
+            self._http = httplib2.Http()
+        parsed = urllib.parse.urlsplit(uri)
+        local = self.url + parsed.path + (f"?{parsed.query}" if parsed.query else "")
+        return self._http.request(local, method, body, headers)
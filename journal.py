@@ -0,0 +1,152 @@
+"""Persistent record of a migration's progress, used by main.py --resume to skip completed work"""
+
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS run (
+    source_root TEXT NOT NULL,
+    dest_root TEXT NOT NULL
+);
+-- every source folder seen, with what's needed to enqueue it again
+CREATE TABLE IF NOT EXISTS folders (
+    source_id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    source_parent TEXT,
+    dest_parent TEXT NOT NULL,
+    dest_id TEXT,
+    done INTEGER NOT NULL DEFAULT 0
+);
+-- files which all actions have completed on
+CREATE TABLE IF NOT EXISTS files (
+    source_id TEXT PRIMARY KEY
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS owners (
+    source_id TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    link TEXT NOT NULL,
+    PRIMARY KEY (source_id, owner)
+) WITHOUT ROWID;
+"""
+
+# commit at least this often (seconds); work done since the last commit is redone on resume
+COMMIT_INTERVAL = 1.0
+
+
+class Journal:
+    """
+    SQLite journal of traversed folders, destination folder ids, completed files and enumerated
+    owners. A folder is done once it has been listed and all its files are done, so the folders
+    which are not done are the frontier to restart from. Safe to share between threads
+    """
+
+    def __init__(self, filename, source_root, dest_root, resume=False):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+
+        if not resume:
+            self.db.executescript(
+                "DROP TABLE IF EXISTS run; DROP TABLE IF EXISTS folders;"
+                "DROP TABLE IF EXISTS files; DROP TABLE IF EXISTS owners;"
+            )
+        self.db.executescript(SCHEMA)
+
+        run = self.db.execute("SELECT source_root, dest_root FROM run").fetchone()
+        if run and run != (source_root, dest_root):
+            raise ValueError(
+                f"Journal {filename} is for {run[0]} -> {run[1]}, not {source_root} -> {dest_root}"
+            )
+        self.resuming = run is not None
+        if not run:
+            self.db.execute("INSERT INTO run VALUES (?, ?)", (source_root, dest_root))
+            # the source root is the first folder of the frontier
+            self.db.execute(
+                "INSERT INTO folders (source_id, name, path, dest_parent, dest_id) "
+                "VALUES (?, '', '', ?, ?)",
+                (source_root, dest_root, dest_root),
+            )
+        self._last_commit = 0.0
+        self._maybe_commit()
+
+    def _maybe_commit(self):
+        if time.monotonic() - self._last_commit > COMMIT_INTERVAL:
+            self.db.commit()
+            self._last_commit = time.monotonic()
+
+    def add_folder(self, path, item, source_parent, dest_parent):
+        """Record a newly enqueued folder. Returns False if it was already known"""
+        with self.lock:
+            cursor = self.db.execute(
+                "INSERT OR IGNORE INTO folders (source_id, name, path, source_parent, dest_parent) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (item.id, item.name, path, source_parent, dest_parent),
+            )
+            self._maybe_commit()
+            return cursor.rowcount == 1
+
+    def folder_resolved(self, source_id, dest_id):
+        with self.lock:
+            self.db.execute(
+                "UPDATE folders SET dest_id = ? WHERE source_id = ?", (dest_id, source_id)
+            )
+            self._maybe_commit()
+
+    def folder_done(self, source_id):
+        with self.lock:
+            self.db.execute("UPDATE folders SET done = 1 WHERE source_id = ?", (source_id,))
+            self._maybe_commit()
+
+    def file_done(self, source_id):
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO files VALUES (?)", (source_id,))
+            self._maybe_commit()
+
+    def is_file_done(self, source_id):
+        with self.lock:
+            return bool(
+                self.db.execute("SELECT 1 FROM files WHERE source_id = ?", (source_id,)).fetchone()
+            )
+
+    def files_done(self):
+        """Return the number of files done"""
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def add_owners(self, source_id, owners, link):
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO owners VALUES (?, ?, ?)",
+                [(source_id, owner, link) for owner in owners],
+            )
+            self._maybe_commit()
+
+    def pending_folders(self):
+        """Return (path, source_id, name, source_parent, dest_parent) of every folder not done"""
+        with self.lock:
+            return self.db.execute(
+                "SELECT path, source_id, name, source_parent, dest_parent FROM folders "
+                "WHERE done = 0"
+            ).fetchall()
+
+    def dest_folders(self):
+        """Return ((dest_parent, name), dest_id) of every destination folder resolved so far"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT dest_parent, name, dest_id FROM folders "
+                "WHERE dest_id IS NOT NULL AND source_parent IS NOT NULL"
+            ).fetchall()
+        return [((dest_parent, name), dest_id) for dest_parent, name, dest_id in rows]
+
+    def owners(self):
+        """Return (source_id, owner, link) of every owner enumerated so far"""
+        with self.lock:
+            return self.db.execute("SELECT source_id, owner, link FROM owners").fetchall()
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
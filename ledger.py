@@ -0,0 +1,66 @@
+"""Persistent record of the emails of each campaign, so compose_emails.py never mails anyone twice"""
+
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    campaign TEXT NOT NULL,
+    email TEXT NOT NULL,
+    -- sending, sent, drafted or failed
+    status TEXT NOT NULL,
+    id TEXT,
+    error TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (campaign, email)
+) WITHOUT ROWID;
+"""
+
+# statuses which mean the recipient was dealt with, for sends and for drafts
+SENT = ("sent",)
+DRAFTED = ("sent", "drafted")
+
+
+class Ledger:
+    """
+    SQLite ledger of the message sent or drafted to each recipient of `campaign`. A recipient is
+    marked "sending" before its request goes out and every change is committed at once, so after a
+    crash a recipient is either done, not done, or left "sending" when we can't know whether Gmail
+    got the message. Safe to share between threads
+    """
+
+    def __init__(self, filename, campaign):
+        self.campaign = campaign
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.executescript(SCHEMA)
+
+    def _set(self, email, status, message_id=None, error=None):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?)",
+                (self.campaign, email, status, message_id, error, time.time()),
+            )
+            self.db.commit()
+
+    def statuses(self):
+        """Return {email: status} for every recipient of the campaign"""
+        with self.lock:
+            return dict(
+                self.db.execute(
+                    "SELECT email, status FROM messages WHERE campaign = ?", (self.campaign,)
+                )
+            )
+
+    def start(self, email):
+        self._set(email, "sending")
+
+    def finish(self, outcome):
+        """Record a compose_emails.Outcome"""
+        self._set(outcome.email, outcome.status, outcome.id, outcome.error)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -1,19 +1,64 @@
 import os
 import argparse
+import csv
+import json
 from pathlib import Path
 from textwrap import dedent
+import multiprocessing
 import queue
-from ssl import SSLEOFError
+import tempfile
+import threading
+import traceback
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from credentials import CredentialsManager, build_service
+from journal import Journal
+from metrics import Metrics, add_metrics_arguments, metrics_from_args
+from owner_index import OwnerIndex
+from plan import Plan
+from progress import Progress
+from ratelimit import (
+    CONNECTION_ERRORS,
+    DRIVE_QPS,
+    MAX_RETRIES,
+    RateLimiter,
+    backoff_delay,
+    is_rate_limited,
+    is_retryable,
+)
+from transport import HttpPool, add_transport_arguments, transport_from_args, transport_options
+
 
 SCOPES = ["https://www.googleapis.com/auth/drive"]
 
+# Drive accepts at most 100 sub-requests per batch request
+BATCH_SIZE = 100
+# ids requested at once from files.generateIds, for creating files idempotently
+GENERATED_IDS = 100
+# locks shared by the files being copied, many more than workers so that few copies wait
+COPY_LOCKS = 256
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+SHORTCUT_MIME_TYPE = "application/vnd.google-apps.shortcut"
+# attributes listed to decide whether a copy is up to date (see Item.same_content)
+CONTENT_FIELDS = "md5Checksum, size, modifiedTime, shortcutDetails(targetId)"
+# appProperties key recording the id of the source file a copy was made from
+COPY_SOURCE_PROPERTY = "copiedFrom"
+# seconds between flushes of the owners file
+OWNERS_FLUSH_INTERVAL = 5
+# with --depth-first, files are handed to workers at most this many per worker ahead of the walk
+DEPTH_FIRST_AHEAD = 4
+# yielded by Runner.children to have the moves of the files yielded so far completed
+MOVES_DONE = object()
+# pages of files moved by Runner.children which are skipped if listed again
+MOVED_PAGES = 2
+
 
 def authenticate(filename_token, filename_credentials):
     """Get an auth token by running a web service at localhost and clicking through an OAuth link"""
@@ -27,43 +72,251 @@ def authenticate(filename_token, filename_credentials):
     if Path(filename_token).exists():
         creds = Credentials.from_authorized_user_file(filename_token, SCOPES)
     if not creds or not creds.valid:
-        if creds and not creds.expired and creds.refresh_token:
+        if creds and creds.expired and creds.refresh_token:
             creds.refresh(Request())
         else:
             flow = InstalledAppFlow.from_client_secrets_file(filename_credentials, scopes=SCOPES)
             creds = flow.run_local_server(open_browser=False)
-            with open(filename_token, "w", encoding="utf-8") as token:
-                token.write(creds.to_json())
+        with open(filename_token, "w", encoding="utf-8") as token:
+            token.write(creds.to_json())
     return creds
 
 
+class Item:
+    """Compact record of a listed file, keeping only the attributes actions use"""
+
+    __slots__ = (
+        "id",
+        "name",
+        "mime_type",
+        "owners",
+        "web_view_link",
+        "md5",
+        "size",
+        "modified_time",
+        "shortcut_target",
+    )
+
+    # pylint: disable=redefined-builtin,too-many-arguments
+    def __init__(
+        self,
+        id,
+        name,
+        mime_type,
+        owners=(),
+        web_view_link=None,
+        md5=None,
+        size=None,
+        modified_time=None,
+        shortcut_target=None,
+    ):
+        self.id = id
+        self.name = name
+        self.mime_type = mime_type
+        self.owners = owners
+        self.web_view_link = web_view_link
+        # content attributes, listed when copying to tell whether a copy is up to date
+        self.md5 = md5
+        self.size = size
+        self.modified_time = modified_time
+        self.shortcut_target = shortcut_target
+
+    @classmethod
+    def from_response(cls, response):
+        """Build an Item from a drive#file resource"""
+        return cls(
+            response["id"],
+            response["name"],
+            response["mimeType"],
+            tuple(owner["emailAddress"] for owner in response.get("owners", ())),
+            response.get("webViewLink"),
+            response.get("md5Checksum"),
+            response.get("size"),
+            response.get("modifiedTime"),
+            response.get("shortcutDetails", {}).get("targetId"),
+        )
+
+    @property
+    def is_folder(self):
+        return self.mime_type == FOLDER_MIME_TYPE
+
+    @property
+    def is_shortcut(self):
+        return self.mime_type == SHORTCUT_MIME_TYPE
+
+    def same_content(self, other):
+        """
+        Return True if `other` (a copy of this item) is up to date: same target for shortcuts,
+        same checksum for files which have one, else same size and modification time
+        """
+        if self.is_shortcut or other.is_shortcut:
+            return self.shortcut_target == other.shortcut_target
+        if self.md5 and other.md5:
+            return self.md5 == other.md5
+        return (self.size, self.modified_time) == (other.size, other.modified_time)
+
+
 # pylint: disable=missing-function-docstring
 class DriveFiles:
     """Use this wrapper class to ensure proper flags are set & errors handled on all requests"""
 
-    def __init__(self, auth_f):
+    def __init__(self, auth_f, limiter=None, metrics=None, http_f=None):
         self.auth_f = auth_f
+        # shared by clones, as they all draw from the same per-user quota
+        self.limiter = limiter or RateLimiter()
+        self.metrics = metrics or Metrics()
+        # optional function of the credentials returning the httplib2.Http-like transport to use:
+        # a transport.HttpPool shared by all clones, or fake_google.FakeGoogle.http to run against
+        # a local fake
+        self.http_f = http_f
+        # prints notices such as reconnections; Runner sets it to its Progress.message
+        self.message = print
+        # "files" or "shortcuts" -> ids for new files, see generated_id
+        self._generated_ids = {}
 
         self._build_drive()
 
     def _build_drive(self):
         creds = self.auth_f()
-        self.drive = build("drive", "v3", credentials=creds)
+        http = self.http_f(creds) if self.http_f else None
+        self.drive = build_service("drive", "v3", creds, http)
+
+    def clone(self):
+        """Return a DriveFiles with its own service object, for use in another thread"""
+        clone = DriveFiles(self.auth_f, self.limiter, self.metrics, self.http_f)
+        clone.message = self.message
+        return clone
 
     def _wrapmethod(self, method_generator, *args, **kwargs):
         """
         Wrap googleapiclient methods, injecting flags which, when missed, cause silent failure
-        to list anything in a shared drive. Also handle SSL timeout errors. To achieve this,
+        to list anything in a shared drive. Also handle broken connections. To achieve this,
         methd_generator must be a lambda or function that takes a drive service and returns the
-        method to be called. This is needed because the service is regenerated on SSL re-auth
+        method to be called. This is needed because the service is rebuilt when the connection is
+        lost. Requests go through self.limiter, and rate limit or server errors are retried with backoff.
+        Each attempt is recorded in self.metrics
         """
         kwargs_wrapped = {**kwargs, "supportsAllDrives": True}
+        return self._execute(lambda drive: method_generator(drive)(*args, **kwargs_wrapped))
+
+    def _execute(self, request_generator):
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            throttled = False
+            try:
+                request = request_generator(self.drive)
+                return self.metrics.execute(request)
+            except CONNECTION_ERRORS:
+                if attempt == MAX_RETRIES:
+                    raise
+                self.message("Connection lost. Reconnecting...")
+                self._build_drive()
+                delay = 0
+            except HttpError as e:
+                if attempt == MAX_RETRIES or not is_retryable(e):
+                    raise
+                throttled = is_rate_limited(e)
+                delay = backoff_delay(attempt, e)
+            finally:
+                self.limiter.release(throttled)
+            self.metrics.retry(request.methodId)
+            time.sleep(delay)
+            attempt += 1
+
+    def _wrapcreate(self, method_generator, body, **kwargs):
+        """
+        _wrapmethod for calls creating a file, which are not idempotent: had Drive created the file
+        before the connection broke, sending the call again would create a second one. So the file
+        is given an id generated beforehand, which makes a resent call fail with 409, and the file
+        created by the first one is returned instead
+        """
+        space_type = "shortcuts" if body.get("mimeType") == SHORTCUT_MIME_TYPE else "files"
+        file_id = self.generated_id(space_type)
+        try:
+            return self._wrapmethod(method_generator, body={**body, "id": file_id}, **kwargs)
+        except HttpError as e:
+            if e.resp.status != 409:
+                raise
+        return self.get(fileId=file_id, fields=kwargs.get("fields"))
+
+    def generated_id(self, space_type="files"):
+        """
+        Return an unused id for a file or, if space_type is "shortcuts", a shortcut. Ids are
+        generated GENERATED_IDS at a time, separately for each clone
+        """
+        ids = self._generated_ids.setdefault(space_type, [])
+        if not ids:
+            response = self._execute(
+                lambda drive: drive.files().generateIds(count=GENERATED_IDS, type=space_type)
+            )
+            ids.extend(reversed(response["ids"]))
+        return ids.pop()
+
+    def _wrapbatch(self, method_generator, kwargs_list):
+        """
+        Batch counterpart of _wrapmethod: run method_generator(drive)(**kwargs) for each entry of
+        kwargs_list, grouping the calls into batch requests of at most BATCH_SIZE sub-requests.
+        Sub-requests failing with a retryable error are resubmitted together after a backoff, again
+        in batches of at most BATCH_SIZE, up to MAX_RETRIES times. Returns a list of (response,
+        error) pairs in the order of kwargs_list
+        """
+        results = [(None, None)] * len(kwargs_list)
+        method_ids = [None] * len(kwargs_list)
+
+        def callback(request_id, response, exception):
+            results[int(request_id)] = (response, exception)
+
+        pending = list(range(len(kwargs_list)))
+        for attempt in range(MAX_RETRIES + 1):
+            for start in range(0, len(pending), BATCH_SIZE):
+                chunk = pending[start : start + BATCH_SIZE]
+                self._execute_batch(
+                    method_generator, kwargs_list, chunk, callback, results, method_ids
+                )
+
+            pending = [i for i in pending if is_retryable(results[i][1])]
+            if not pending or attempt == MAX_RETRIES:
+                break
+            for i in pending:
+                self.metrics.retry(method_ids[i])
+            time.sleep(backoff_delay(attempt, results[pending[0]][1]))
+
+        return results
+
+    # pylint: disable=too-many-arguments
+    def _execute_batch(self, method_generator, kwargs_list, indices, callback, results, method_ids):
+        # every sub-request counts against the quota
+        self.limiter.acquire(len(indices))
         try:
-            return method_generator(self.drive)(*args, **kwargs_wrapped).execute()
-        except SSLEOFError:
-            print("Auth token expired. Reauthenticating...")
-            self._build_drive()
-            return method_generator(self.drive)(*args, **kwargs_wrapped).execute()
+            try:
+                self._send_batch(method_generator, kwargs_list, indices, callback, method_ids)
+            except CONNECTION_ERRORS:
+                self.message("Connection lost. Reconnecting...")
+                self._build_drive()
+                self._send_batch(method_generator, kwargs_list, indices, callback, method_ids)
+        except HttpError as e:
+            # the batch request as a whole failed: so did each of its sub-requests
+            if not is_retryable(e):
+                raise
+            for i in indices:
+                results[i] = (None, e)
+        finally:
+            self.limiter.release(any(is_rate_limited(results[i][1]) for i in indices))
+        # sub-requests have no latency of their own, it is recorded under drive.batch
+        for i in indices:
+            self.metrics.record(method_ids[i], error=results[i][1])
+
+    # pylint: disable=too-many-arguments
+    def _send_batch(self, method_generator, kwargs_list, indices, callback, method_ids):
+        batch = self.drive.new_batch_http_request(callback=callback)
+        for i in indices:
+            kwargs_wrapped = {**kwargs_list[i], "supportsAllDrives": True}
+            request = self.metrics.instrument(method_generator(self.drive)(**kwargs_wrapped))
+            method_ids[i] = request.methodId
+            batch.add(request, request_id=str(i))
+        with self.metrics.timed("drive.batch"):
+            batch.execute()
 
     def list(self, *args, **kwargs):
         return self._wrapmethod(
@@ -75,15 +328,30 @@ class DriveFiles:
             },
         )
 
-    def copy(self, *args, **kwargs):
-        return self._wrapmethod(lambda drive: drive.files().copy, *args, **kwargs)
+    def copy(self, body, **kwargs):
+        return self._wrapcreate(lambda drive: drive.files().copy, body, **kwargs)
 
-    def create(self, *args, **kwargs):
-        return self._wrapmethod(lambda drive: drive.files().create, *args, **kwargs)
+    def create(self, body, **kwargs):
+        return self._wrapcreate(lambda drive: drive.files().create, body, **kwargs)
 
     def get(self, *args, **kwargs):
+        return self._wrapmethod(lambda drive: drive.files().get, *args, **kwargs)
+
+    def update(self, *args, **kwargs):
+        return self._wrapmethod(lambda drive: drive.files().update, *args, **kwargs)
+
+    def update_many(self, kwargs_list):
+        return self._wrapbatch(lambda drive: drive.files().update, kwargs_list)
+
+    def permissions(self, *args, **kwargs):
+        return self._wrapmethod(lambda drive: drive.permissions().list, *args, **kwargs)
+
+    def permissions_many(self, kwargs_list):
+        return self._wrapbatch(lambda drive: drive.permissions().list, kwargs_list)
+
+    def changes(self, *args, **kwargs):
         return self._wrapmethod(
-            lambda drive: drive.files().get,
+            lambda drive: drive.changes().list,
             *args,
             **{
                 **kwargs,
@@ -91,166 +359,1229 @@ class DriveFiles:
             },
         )
 
-    def update(self, *args, **kwargs):
-        return self._wrapmethod(lambda drive: drive.files().update, *args, **kwargs)
-
-    def permissions(self, *args, **kwargs):
-        return self._wrapmethod(lambda drive: drive.permissions().list, *args, **kwargs)
+    def start_page_token(self, *args, **kwargs):
+        return self._wrapmethod(lambda drive: drive.changes().getStartPageToken, *args, **kwargs)
 
 
 class Runner:
-    def __init__(self, drive, owners_file):
-        self.drive = drive
-        # for enumerating drive owners, if specified
-        self.owners = {}
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        drive,
+        owners_file,
+        batch_moves=False,
+        workers=1,
+        use_index=False,
+        journal=None,
+        listed_owners=False,
+        owner_index=None,
+        plan=None,
+        progress=None,
+        depth_first=False,
+    ):
+        # DriveFiles of the main thread; worker threads each get their own (see `drive`)
+        self._drive = drive
+        self._local = threading.local()
+        self.workers = workers
+        # guards everything below which is shared between workers
+        self.lock = threading.Lock()
+        self._folder_locks = {}
+        # guard copies, by hash of (destination parent id, source file id): a lock per file would
+        # add up to one per file copied
+        self._copy_locks = [threading.Lock() for _ in range(COPY_LOCKS)]
+        # moves waiting to be sent as a batch request, if batching
+        self.batch_moves = batch_moves
+        self.pending_moves = []
+        # walk depth-first, listing folders lazily (see walk_depth_first) rather than breadth-first
+        self.depth_first = depth_first
+        # parent id -> children of the source tree, if listing from a bulk index
+        self.use_index = use_index
+        self.index = None
+        # number of files.list calls made to list the source tree
+        self.list_calls = 0
+        # for enumerating drive owners, if specified; a temporary index unless one is given
+        self.owner_index = owner_index or OwnerIndex()
+        self._own_index = owner_index is None
+        self.owner_emails = set()
+        self.owner_entries = 0
         self.insufficient_permissions = set()
-        self.output_buffer = {}
+        # path -> id of the source folders whose files weren't all listed, see children()
+        self.abandoned = {}
+        # counts and status messages, rendered by its own thread while running
+        self.progress = progress or Progress(drive.metrics)
+        drive.message = self.progress.message
+
+        # trust the owners returned by listing, only calling permissions.list when there are none
+        self.listed_owners = listed_owners
+        self.pending_permissions = []
+        self.permission_calls_avoided = 0
+        self.no_owners = set()
+        # requests rate limited in other processes, see merge_results
+        self.throttled = 0
 
+        self.owners_file = None
+        self.owners_writer = None
+        self._owners_flushed = time.monotonic()
         if owners_file:
-            with open(owners_file, "w", encoding="utf-8") as f:
-                print(", ".join(("Email", "File link")), file=f)
+            # pylint: disable=consider-using-with
+            self.owners_file = open(owners_file, "w", newline="", encoding="utf-8")
+            self.owners_writer = csv.writer(self.owners_file)
+            self.owners_writer.writerow(("Email", "File link"))
+        # (destination parent id, folder name) -> destination folder id
+        self.dest_folders = {}
+        # destination folders whose child folders are all in dest_folders
+        self.dest_listed = set()
+        # (destination parent id, source file id) -> Item of the copies in listed destination
+        # folders, if copying. Keyed by source rather than name, as a folder can hold several files
+        # with the same name
+        self.dest_files = {}
+        self.copied = 0
+        self.copies_up_to_date = 0
+        self.copy_errors = {}
+        # progress journal, if any, and files not yet done per source folder (+1 while listing it)
+        self.journal = journal
+        self._outstanding = {}
+        # file id -> number of actions on it still in flight (see hold/release)
+        self._holds = {}
+        # source folder id -> [(id, name), ...] of its folders below the source root, or None if it
+        # isn't under the source root, for incremental runs
+        self._chains = {}
+        # token to pass to the next incremental run, set by run(changes_token=...)
+        self.changes_token = None
+        # plan.Plan recording the changes to make instead of making them, if planning
+        self.plan = plan
+        # actions to run on files, set by run()
+        self.move_files = False
+        self.copy_files = False
+        self.enumerate_owners = False
+        # file attributes to request when listing, derived from the actions by run()
+        self.fields = "id, mimeType, name"
+
+    @property
+    def drive(self):
+        """The DriveFiles of the current thread, since googleapiclient services aren't thread-safe"""
+        return getattr(self._local, "drive", self._drive)
+
+    def status(self, key, message):
+        """Set the status line entry `key` to `message`"""
+        self.progress.status(key, message)
+
+    def list_page(self, folder_id, page_token=None, query=""):
+        """Return (children of `folder_id` on the page `page_token`, next page's token or None)"""
+        with self.lock:
+            self.list_calls += 1
+        response = self.drive.list(
+            q=f'"{folder_id}" in parents and trashed = false{query}',
+            pageSize=1000,
+            pageToken=page_token,
+            # only request what the enabled actions use: files(*) returns capabilities, export
+            # links, thumbnails etc. which make responses many times larger
+            # NB: you can set files(*) to see _all_ available fields
+            fields=f"nextPageToken, files({self.fields})",
+        )
+        return map(Item.from_response, response["files"]), response.get("nextPageToken", None)
+
+    def listdir(self, folder_id, query=""):
+        """Yield all children of `id` (matching `query`, e.g. ' and name = ...', unless indexed)"""
+        if self.index is not None:
+            yield from self.index.get(folder_id, ())
+            return
 
-        self.owners_file = owners_file
+        page_token = None
+        while True:
+            items, page_token = self.list_page(folder_id, page_token, query)
+            yield from items
+            if not page_token:
+                break
+
+    def build_index(self, source_root):
+        """
+        Index the source tree by parent id using a few large paginated scans of every non-trashed
+        file in the corpus holding source_root, rather than one query per folder
+        """
+        root = self.drive.get(fileId=source_root, fields="id, driveId")
+        if "driveId" in root:
+            corpus = {"corpora": "drive", "driveId": root["driveId"]}
+        else:
+            corpus = {"corpora": "user"}
 
-    def listdir(self, folder_id):
-        """Yield all children of `id`"""
+        children = {}
         page_token = None
         while True:
+            self.list_calls += 1
             response = self.drive.list(
-                q=f'"{folder_id}" in parents and trashed = false',
+                q="trashed = false",
                 pageSize=1000,
                 pageToken=page_token,
-                # by providing fields we can specify shortcutDetails which avoids an extra call when
-                # copying shortcuts and modifiedTime and size which we use when deciding whether to copy
-                # NB: you can set files(*) to see _all_ available fields
-                fields="nextPageToken, files(*)",
+                fields=f"nextPageToken, files({self.fields}, parents)",
+                **corpus,
+            )
+            for response_item in response["files"]:
+                item = Item.from_response(response_item)
+                for parent in response_item.get("parents", ()):
+                    children.setdefault(parent, []).append(item)
+            self.status("index", f"Indexed {sum(len(v) for v in children.values())} files")
+            page_token = response.get("nextPageToken", None)
+            if not page_token:
+                break
+
+        # the corpus can be much larger than the source tree: keep only what's under source_root
+        self.index = {}
+        folders = [source_root]
+        while folders:
+            folder_id = folders.pop()
+            if folder_id in self.index or folder_id not in children:
+                continue
+            self.index[folder_id] = children[folder_id]
+            folders.extend(item.id for item in children[folder_id] if item.is_folder)
+
+        folder_count = sum(1 for items in self.index.values() for item in items if item.is_folder)
+        file_count = sum(len(v) for v in self.index.values()) - folder_count
+        self.status("index", None)
+        self.progress.total = file_count
+        self.progress.message(
+            f"Indexed {file_count + folder_count} files under the source with "
+            f"{self.list_calls} files.list calls; a recursive walk would make at least "
+            f"{folder_count + 1} (one per folder)"
+        )
+
+    def index_destination(self, dest_root):
+        """
+        If dest_root is in a shared drive, load every folder of that drive into the destination
+        folder cache with a few paginated scans
+        """
+        root = self.drive.get(fileId=dest_root, fields="id, driveId")
+        if "driveId" not in root:
+            return
+
+        if self.copy_files:
+            query = "trashed = false"
+            fields = (
+                "nextPageToken, files(id, name, mimeType, parents, appProperties, "
+                f"{CONTENT_FIELDS})"
             )
+        else:
+            query = f'mimeType = "{FOLDER_MIME_TYPE}" and trashed = false'
+            fields = "nextPageToken, files(id, name, parents)"
+        children = list(
+            self.list_pages(q=query, fields=fields, corpora="drive", driveId=root["driveId"])
+        )
+        folders = []
+        with self.lock:
+            for child in children:
+                is_folder = child.get("mimeType", FOLDER_MIME_TYPE) == FOLDER_MIME_TYPE
+                if is_folder:
+                    folders.append(child)
+                for parent in child.get("parents", ()):
+                    if is_folder:
+                        self.dest_folders.setdefault((parent, child["name"]), child["id"])
+                    else:
+                        self.add_dest_file(parent, child)
+            self.dest_listed.update(folder["id"] for folder in folders)
+            self.dest_listed.add(dest_root)
+
+    def list_pages(self, **kwargs):
+        """Yield every file matching a files.list query, following pagination"""
+        page_token = None
+        while True:
+            response = self.drive.list(pageSize=1000, pageToken=page_token, **kwargs)
             yield from response["files"]
             page_token = response.get("nextPageToken", None)
             if not page_token:
                 break
 
-    def get_one(self, q):
-        """Return the attributes of a single file using drive#list"""
-        try:
-            return self.drive.list(q=q)["files"][0]
-        except IndexError:
-            return None
+    def load_dest_folders(self, dest):
+        """
+        Add the child folders of destination folder `dest` to the destination folder cache, and
+        its files to the destination file cache if copying
+        """
+        if self.copy_files:
+            query = f'"{dest}" in parents and trashed = false'
+            fields = f"nextPageToken, files(id, name, mimeType, appProperties, {CONTENT_FIELDS})"
+        else:
+            query = f'"{dest}" in parents and mimeType = "{FOLDER_MIME_TYPE}" and trashed = false'
+            fields = "nextPageToken, files(id, name)"
+        children = list(self.list_pages(q=query, fields=fields))
+        with self.lock:
+            for child in children:
+                if child.get("mimeType", FOLDER_MIME_TYPE) == FOLDER_MIME_TYPE:
+                    self.dest_folders.setdefault((dest, child["name"]), child["id"])
+                else:
+                    self.add_dest_file(dest, child)
+            self.dest_listed.add(dest)
+
+    def add_dest_file(self, dest, response):
+        """Add the drive#file resource of a file in `dest` to the cache, if it is a copy we made"""
+        source_id = response.get("appProperties", {}).get(COPY_SOURCE_PROPERTY)
+        if source_id:
+            self.dest_files.setdefault((dest, source_id), Item.from_response(response))
+
+    def _lock_for(self, key):
+        with self.lock:
+            return self._folder_locks.setdefault(key, threading.Lock())
+
+    def resolve_folder(self, item, dest):
+        """Return (folder_id, created): the folder named like `item` in `dest`, created if needed"""
+        with self._lock_for(dest):
+            if dest not in self.dest_listed:
+                self.load_dest_folders(dest)
+
+        cache_key = (dest, item.name)
+        # two source folders with the same name map to the same destination folder, so concurrent
+        # workers must not both find it missing and create it twice
+        with self._lock_for(cache_key):
+            with self.lock:
+                folder_id = self.dest_folders.get(cache_key)
+            if folder_id:
+                return folder_id, False
+
+            if self.plan:
+                folder = {"id": self.plan.mkdir(dest, item.name)}
+            else:
+                folder = self.drive.create(
+                    body={"name": item.name, "mimeType": item.mime_type, "parents": [dest]},
+                    fields="id",
+                )
+            with self.lock:
+                self.dest_folders[cache_key] = folder["id"]
+                # a folder we just created has no children to look up
+                self.dest_listed.add(folder["id"])
+            return folder["id"], True
+
+    def action_move(self, item, parent_id, dest, item_path):
+        """Action: move the enqueued item to folder {dest}"""
+        if self.plan:
+            self.plan.move(item_path, item.id, parent_id, dest)
+            return
+
+        if self.batch_moves:
+            self.hold(item)
+            with self.lock:
+                self.pending_moves.append((item, parent_id, dest, item_path))
+                full = len(self.pending_moves) >= BATCH_SIZE
+            if full:
+                self.flush_moves()
+            return
+
+        self.drive.update(fileId=item.id, addParents=dest, removeParents=parent_id)
+        self.status("moveFile", f"Moving {item.name}")
+
+    def flush_moves(self):
+        """Send all pending moves as batch requests, raising the first error which was not retried"""
+        with self.lock:
+            pending, self.pending_moves = self.pending_moves, []
+        if pending:
+            self.send_moves(pending)
 
-    def action_move(self, item, parent_id, dest):
-        """Action: move the enqueued item to folder {parent_id}"""
-        self.drive.update(fileId=item["id"], addParents=dest, removeParents=parent_id)
-        self.output_buffer["moveFile"] = f'Moving {item["name"]}'
+    def send_moves(self, pending):
+        """Move each (item, parent_id, dest, item_path) of `pending` with batch requests"""
+        results = self.drive.update_many(
+            [
+                {"fileId": item.id, "addParents": dest, "removeParents": parent_id}
+                for (item, parent_id, dest, _) in pending
+            ]
+        )
+
+        errors = []
+        for (item, parent_id, _, item_path), (_, error) in zip(pending, results):
+            if error is None:
+                self.release(item, parent_id)
+            else:
+                errors.append((item_path, error))
+        self.status("moveFile", f"Moved {len(pending) - len(errors)} files")
+        if errors:
+            self.progress.message(
+                "", *(f"Error on file {item_path}: {error}" for item_path, error in errors), ""
+            )
+            raise errors[0][1]
+
+    def action_copy(self, item, dest, item_path):
+        """
+        Action: copy the enqueued item into folder {dest}, unless an up to date copy is there.
+        Copies record the id of their source in their appProperties, by which later runs find them
+        """
+        with self._lock_for(dest):
+            if dest not in self.dest_listed:
+                self.load_dest_folders(dest)
+
+        cache_key = (dest, item.id)
+        # a file listed twice (e.g. by an incremental run) must not be copied twice concurrently
+        with self._copy_locks[hash(cache_key) % COPY_LOCKS]:
+            with self.lock:
+                existing = self.dest_files.get(cache_key)
+            if existing and item.same_content(existing):
+                with self.lock:
+                    self.copies_up_to_date += 1
+                return
+
+            body = {
+                "name": item.name,
+                "parents": [dest],
+                "appProperties": {COPY_SOURCE_PROPERTY: item.id},
+            }
+            fields = f"id, name, mimeType, appProperties, {CONTENT_FIELDS}"
+            try:
+                if item.is_shortcut:
+                    # copying a shortcut isn't allowed: make a new one pointing to the same file
+                    copy = self.drive.create(
+                        body={
+                            **body,
+                            "mimeType": SHORTCUT_MIME_TYPE,
+                            "shortcutDetails": {"targetId": item.shortcut_target},
+                        },
+                        fields=fields,
+                    )
+                else:
+                    copy = self.drive.copy(
+                        fileId=item.id,
+                        # keeping modifiedTime lets later runs tell whether the source changed
+                        body={**body, "modifiedTime": item.modified_time},
+                        fields=fields,
+                    )
+            except HttpError as e:
+                # e.g. files whose owner disabled copying: report them rather than stopping
+                if e.resp.status not in (403, 404):
+                    raise
+                with self.lock:
+                    self.copy_errors[item_path] = str(e.reason)
+                return
+
+            if existing:
+                # the previous copy is out of date: trash it (rather than delete, to be safe)
+                self.drive.update(fileId=existing.id, body={"trashed": True})
+            with self.lock:
+                self.dest_files[cache_key] = Item.from_response(copy)
+                self.copied += 1
+        self.status("copyFile", f"Copied {item.name}")
 
-    def action_enumerate_owners(self, item):
+    def action_enumerate_owners(self, item, parent_id, item_path):
         """Action: print owner of item"""
+        if self.listed_owners:
+            if item.owners:
+                with self.lock:
+                    self.permission_calls_avoided += 1
+                self.add_owners(item, set(item.owners))
+                return
+
+            # e.g. shared drive items have no owners field: look them up in a batch
+            self.hold(item)
+            with self.lock:
+                self.pending_permissions.append((item, parent_id, item_path))
+                full = len(self.pending_permissions) >= BATCH_SIZE
+            if full:
+                self.flush_permissions()
+            return
 
         try:
             permissions = self.drive.permissions(
-                fileId=item["id"], fields="permissions(emailAddress,role)"
+                fileId=item.id, fields="permissions(emailAddress,role)"
             )["permissions"]
         except HttpError as e:
             if "does not have sufficient permissions" in str(e):
-                self.insufficient_permissions.add(item["id"])
+                with self.lock:
+                    self.insufficient_permissions.add(item.id)
                 return
 
             raise e
 
         if not permissions:
-            raise ValueError(f'No permissions found for {item["id"]}')
+            raise ValueError(f"No permissions found for {item.id}")
 
-        owners = set([x["emailAddress"] for x in permissions if x["role"] == "owner"])
+        owners = self.owners_from_permissions(permissions)
         if not owners:
-            raise ValueError(f'No owners found for {item["id"]}')
+            raise ValueError(f"No owners found for {item.id}")
 
-        if item["owners"]:
-            owners |= set([x["emailAddress"] for x in item["owners"]])
+        self.add_owners(item, owners | set(item.owners))
 
-        for owner in owners:
-            entry = self.owners.get(owner, set())
-            entry.add(item["webViewLink"])
-            self.owners[owner] = entry
+    def flush_permissions(self):
+        """Look up the owners of all items waiting for permissions.list as batch requests"""
+        with self.lock:
+            pending, self.pending_permissions = self.pending_permissions, []
+        if not pending:
+            return
 
-        if self.owners_file:
-            with open(self.owners_file, "a", encoding="utf-8") as f:
-                for owner in owners:
-                    print(", ".join((owner, item["webViewLink"])), file=f)
-
-        self.output_buffer["owners"] = (
-            f"{len(self.owners.keys())} owners for {sum([len(v) for v in self.owners.values()])} files"
+        results = self.drive.permissions_many(
+            [
+                {"fileId": item.id, "fields": "permissions(emailAddress,role)"}
+                for (item, _, _) in pending
+            ]
         )
 
-    def run(self, source_root, dest_root, move_files, enumerate_owners):
-        """Run the specified action on dest_root, reproducing the directory structure of source_root"""
-        q = queue.Queue()
-        drive = self.drive
+        errors = []
+        for (item, parent_id, item_path), (response, error) in zip(pending, results):
+            if error is None:
+                owners = self.owners_from_permissions(response["permissions"])
+                if owners:
+                    self.add_owners(item, owners)
+                else:
+                    # e.g. shared drive items, which belong to the drive rather than a person
+                    with self.lock:
+                        self.no_owners.add(item.id)
+            elif "does not have sufficient permissions" in str(error):
+                with self.lock:
+                    self.insufficient_permissions.add(item.id)
+            else:
+                errors.append((item_path, error))
+                continue
+            self.release(item, parent_id)
+
+        if errors:
+            self.progress.message(
+                "", *(f"Error on file {item_path}: {error}" for item_path, error in errors), ""
+            )
+            raise errors[0][1]
 
-        for item in self.listdir(source_root):
-            q.put(("/", item, source_root, dest_root))
+    @staticmethod
+    def owners_from_permissions(permissions):
+        return set([x["emailAddress"] for x in permissions if x["role"] == "owner"])
 
-        while not q.empty():
-            (folder_name, item, parent_id, dest) = q.get()
+    def add_owners(self, item, owners):
+        if self.plan:
+            self.plan.add_owners(item.id, owners, item.web_view_link)
+            return
+        if self.journal:
+            self.journal.add_owners(item.id, owners, item.web_view_link)
+        self.record_owners(item.id, owners, item.web_view_link)
 
-            item_path = os.path.join(folder_name, item["name"])
+    def record_owners(self, file_id, owners, link):
+        """Add the owners of a file to the owner index and the owners file, skipping known ones"""
+        new_owners = self.owner_index.add(file_id, owners, link)
+        with self.lock:
+            self.owner_emails.update(new_owners)
+            self.owner_entries += len(new_owners)
 
-            # if folder, create destination folder and add children to queue
-            if item["mimeType"] == "application/vnd.google-apps.folder":
-                maybe_f = self.get_one(
-                    (
-                        f'"{dest}" in parents and trashed = false '
-                        f'and name = "{item["name"]}" and mimeType = "{item["mimeType"]}"'
-                    ),
-                )
-                if maybe_f:
-                    folder = maybe_f
+            if self.owners_writer and new_owners:
+                self.owners_writer.writerows((owner, link) for owner in new_owners)
+                if time.monotonic() - self._owners_flushed > OWNERS_FLUSH_INTERVAL:
+                    self.owners_file.flush()
+                    self._owners_flushed = time.monotonic()
+
+            self.status("owners", f"{len(self.owner_emails)} owners for {self.owner_entries} files")
+
+    def _folder_progress(self, folder_id, delta):
+        """Track the files left in a source folder, journaling the folder as done when none are"""
+        with self.lock:
+            left = self._outstanding.get(folder_id, 0) + delta
+            if left:
+                self._outstanding[folder_id] = left
+            else:
+                self._outstanding.pop(folder_id, None)
+        if not left:
+            self.journal.folder_done(folder_id)
+
+    def hold(self, item):
+        """Delay journaling `item` as done until a matching release()"""
+        if self.journal:
+            with self.lock:
+                self._holds[item.id] = self._holds.get(item.id, 0) + 1
+
+    def release(self, item, parent_id):
+        """Undo one hold() on `item`, journaling it as done when no actions are left in flight"""
+        if not self.journal:
+            return
+        with self.lock:
+            left = self._holds[item.id] - 1
+            if left:
+                self._holds[item.id] = left
+            else:
+                del self._holds[item.id]
+        if not left:
+            self.journal.file_done(item.id)
+            self._folder_progress(parent_id, -1)
+
+    def list_folder(self, path, folder_id, dest_id, put):
+        """
+        Call `put` with the entries of the children of source folder `folder_id`. When moving, the
+        folder is listed in full first, as workers moving its files out of it while it is paged
+        through would make later pages skip some
+        """
+        if self.journal:
+            self._folder_progress(folder_id, 1)
+
+        children = self.listdir(folder_id)
+        if self.move_files and not self.plan:
+            children = list(children)
+
+        files = 0
+        for child_item in children:
+            if self.journal:
+                if child_item.is_folder:
+                    # known folders are either done or already part of the resumed frontier
+                    if not self.journal.add_folder(path, child_item, folder_id, dest_id):
+                        continue
+                elif self.journal.is_file_done(child_item.id):
+                    continue
                 else:
-                    folder = drive.create(
-                        body={
-                            **{key: item[key] for key in ["name", "mimeType"]},
-                            "parents": [dest],
-                        },
-                    )
+                    self._folder_progress(folder_id, 1)
 
-                self.output_buffer["folder"] = (
-                    f'Folder: {item_path}{"" if maybe_f else " (created)"}'
-                )
+            if not child_item.is_folder:
+                files += 1
+            put((path, child_item, folder_id, dest_id))
+
+        self.progress.add(folders=1, files=files)
+        if self.journal:
+            self._folder_progress(folder_id, -1)
+
+    def children(self, path, folder_id, dest_id):
+        """
+        Yield the queue entries of the children of source folder `folder_id`, listing a page at a
+        time as they are consumed. Paging through a folder while its files are moved out of it can
+        skip some, so when moving, its folders are listed first, then its files a page at a time
+        from the start, yielding MOVES_DONE after each page to have its moves completed first.
+        Listings can lag behind moves, so files listed again are skipped; a page of nothing else is
+        listed again after a backoff, up to MAX_RETRIES times before giving up on the folder
+        """
+        self.progress.add(folders=1)
+        if self.index is not None or not self.move_files or self.plan:
+            for item in self.listdir(folder_id):
+                if not item.is_folder:
+                    self.progress.add(files=1)
+                yield (path, item, folder_id, dest_id)
+            return
 
-                for child_item in self.listdir(item["id"]):
-                    q.put(
-                        (
-                            item_path,
-                            child_item,
-                            item["id"],
-                            folder["id"],
-                        )
+        for item in self.listdir(folder_id, f" and mimeType = '{FOLDER_MIME_TYPE}'"):
+            yield (path, item, folder_id, dest_id)
+        # ids of the files yielded, and so moved, from the last MOVED_PAGES pages: listings only
+        # lag a little, so memory needn't grow with the width of the folder
+        moved = deque(maxlen=MOVED_PAGES)
+        attempt = 0
+        while True:
+            items, _ = self.list_page(folder_id, query=f" and mimeType != '{FOLDER_MIME_TYPE}'")
+            items = list(items)
+            if not items:
+                return
+            items = [item for item in items if not any(item.id in page for page in moved)]
+            if not items:
+                if attempt == MAX_RETRIES:
+                    with self.lock:
+                        self.abandoned[path] = folder_id
+                    self.progress.message(
+                        f"Files of {path} are still listed after being moved, giving up on it"
                     )
+                    return
+                time.sleep(backoff_delay(attempt))
+                attempt += 1
+                continue
+            attempt = 0
+            self.progress.add(files=len(items))
+            for item in items:
+                yield (path, item, folder_id, dest_id)
+            yield MOVES_DONE
+            moved.append({item.id for item in items})
+
+    def walk_depth_first(self, entries):
+        """
+        Process the queue entries of the iterator `entries`, walking depth-first into folders as
+        they are met. Only the listings of the folders on the current path are open, each holding
+        a page, so memory grows with the depth of the tree rather than its width. Files are
+        processed by self.workers threads, at most DEPTH_FIRST_AHEAD per worker ahead of the walk
+        """
+
+        def init_worker():
+            self._local.drive = self._drive.clone()
+
+        in_flight = set()
+
+        def collect(futures):
+            for future in futures:
+                in_flight.discard(future)
+                future.result()
+
+        stack = [entries]
+        with ThreadPoolExecutor(self.workers, initializer=init_worker) as pool:
+            while stack:
+                entry = next(stack[-1], None)
+                if entry is None:
+                    stack.pop()
+                elif entry is MOVES_DONE:
+                    collect(as_completed(list(in_flight)))
+                    self.flush_moves()
+                elif entry[1].is_folder:
+                    path, item, _, dest = entry
+                    item_path, folder_id = self.enter_folder(path, item, dest)
+                    stack.append(self.children(item_path, item.id, folder_id))
+                elif self.workers == 1:
+                    self.process(None, *entry)
+                else:
+                    if len(in_flight) >= DEPTH_FIRST_AHEAD * self.workers:
+                        collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+                    in_flight.add(pool.submit(self.process, None, *entry))
+            collect(as_completed(list(in_flight)))
+
+    def resume(self, put):
+        """Restore state from the journal and enqueue the folders which are not done"""
+        with self.lock:
+            self.dest_folders.update(self.journal.dest_folders())
+        for file_id, owner, link in self.journal.owners():
+            self.record_owners(file_id, (owner,), link)
+
+        pending = self.journal.pending_folders()
+        done = self.journal.files_done()
+        self.progress.restore(done)
+        if self.move_files and self.progress.total is not None:
+            # the index only has the files which were not moved yet
+            self.progress.total += done
+        self.progress.message(f"Resuming from journal: {len(pending)} folders left to process")
+        for path, source_id, name, source_parent, dest_parent in pending:
+            if source_parent is None:
+                # the source root, which has no destination folder to resolve
+                self.list_folder("/", source_id, dest_parent, put)
+            else:
+                item = Item(source_id, name, FOLDER_MIME_TYPE)
+                put((path, item, source_parent, dest_parent))
+
+    def changes_scope(self, source_root):
+        """Parameters selecting the changes feed which covers source_root"""
+        root = self.drive.get(fileId=source_root, fields="id, driveId")
+        return {"driveId": root["driveId"]} if "driveId" in root else {}
+
+    def start_changes(self, source_root):
+        """Return a changes feed token from which a later incremental run can start"""
+        scope = self.changes_scope(source_root)
+        return self.drive.start_page_token(**scope)["startPageToken"]
 
+    def source_chain(self, folder_id, source_root, known=None):
+        """
+        Return [(id, name), ...] of the folders from below source_root down to folder_id, or None.
+        Folders are taken from `known` (id -> drive#file resource, e.g. from the changes feed) if
+        there, and fetched with files.get otherwise
+        """
+        unknown = []
+        current = folder_id
+        while current != source_root and current not in self._chains:
+            folder = (known or {}).get(current)
+            if folder is None:
+                try:
+                    folder = self.drive.get(fileId=current, fields="id, name, parents, trashed")
+                except HttpError as e:
+                    # parents we can't see (e.g. someone else's My Drive root) aren't under the
+                    # source
+                    if e.resp.status not in (403, 404):
+                        raise
+                    folder = {}
+            parents = folder.get("parents", [])
+            if folder.get("trashed") or not parents:
+                chain = None
+                break
+            unknown.append((current, folder["name"]))
+            current = parents[0]
+        else:
+            chain = [] if current == source_root else self._chains[current]
+
+        for folder in reversed(unknown):
+            chain = None if chain is None else chain + [folder]
+            self._chains[folder[0]] = chain
+        return chain
+
+    def changed_entries(self, source_root, dest_root, page_token):
+        """
+        Return queue entries for the files and folders changed under source_root since
+        page_token, and the token to start from next time
+        """
+        changed = {}
+        scope = self.changes_scope(source_root)
+        while True:
+            response = self.drive.changes(
+                pageToken=page_token,
+                pageSize=1000,
+                fields=(
+                    "nextPageToken, newStartPageToken, "
+                    f"changes(fileId, removed, file({self.fields}, parents, trashed))"
+                ),
+                **scope,
+            )
+            for change in response["changes"]:
+                changed[change["fileId"]] = change
+            if "newStartPageToken" in response:
+                break
+            page_token = response["nextPageToken"]
+
+        # the files moved by the last run are now in destination folders, which aren't under the
+        # source: settle the known ones without looking them up
+        with self.lock:
+            outside = {dest_root, *self.dest_folders.values()}
+        for folder_id in outside:
+            self._chains.setdefault(folder_id, None)
+        # folders changed since page_token, e.g. those the last run created, need no files.get
+        known = {
+            change["fileId"]: change["file"]
+            for change in changed.values()
+            if change.get("file", {}).get("mimeType") == FOLDER_MIME_TYPE
+        }
+
+        candidates = []
+        for change in changed.values():
+            file = change.get("file")
+            if change.get("removed") or not file or file.get("trashed"):
                 continue
+            for parent in file.get("parents", ()):
+                chain = self.source_chain(parent, source_root, known)
+                if chain is not None:
+                    candidates.append((chain, Item.from_response(file), parent))
+                    break
+
+        # a changed folder is walked entirely, so skip changes below another changed folder
+        changed_folders = {item.id for _, item, _ in candidates if item.is_folder}
+        entries = []
+        for chain, item, parent in candidates:
+            if any(folder_id in changed_folders for folder_id, _ in chain):
+                continue
+            dest = dest_root
+            for folder_id, name in chain:
+                dest, _ = self.resolve_folder(Item(folder_id, name, FOLDER_MIME_TYPE), dest)
+            path = "/" + "/".join(name for _, name in chain)
+            entries.append((path, item, parent, dest))
+
+        return entries, response["newStartPageToken"]
+
+    def enter_folder(self, folder_name, item, dest):
+        """Resolve the destination folder of source folder `item`, returning (path, folder id)"""
+        item_path = os.path.join(folder_name, item.name)
+        folder_id, created = self.resolve_folder(item, dest)
+        if self.journal:
+            self.journal.folder_resolved(item.id, folder_id)
+        self.status("folder", f'Folder: {item_path}{" (created)" if created else ""}')
+        return item_path, folder_id
+
+    def process(self, put, folder_name, item, parent_id, dest):
+        """Handle one enqueued item, calling `put` with the entries of a folder's children"""
+        item_path = os.path.join(folder_name, item.name)
 
-            # else, run actions
+        # if folder, create destination folder and add children to queue
+        if item.is_folder:
+            item_path, folder_id = self.enter_folder(folder_name, item, dest)
+            self.list_folder(item_path, item.id, folder_id, put)
+            return
+
+        # else, run actions. Actions which are batched hold the item until their batch is sent
+        try:
+            self.hold(item)
+            if self.move_files:
+                self.action_move(item, parent_id, dest, item_path)
+
+            if self.copy_files:
+                self.action_copy(item, dest, item_path)
+
+            if self.enumerate_owners:
+                self.action_enumerate_owners(item, parent_id, item_path)
+
+            self.release(item, parent_id)
+            self.progress.add(done=1)
+        except HttpError as e:
+            self.progress.message("", f"Error on file {item_path}.", "")
+            raise e
+
+    def close(self):
+        if self.owners_file:
+            self.owners_file.close()
+        if self._own_index:
+            self.owner_index.close()
+
+    def run_concurrent(self, q):
+        """Process `q` until it is exhausted with a pool of self.workers threads"""
+        errors = []
+
+        def worker():
             try:
-                if move_files:
-                    self.action_move(item, parent_id, dest)
+                self._local.drive = self._drive.clone()
+            except Exception as e:  # pylint: disable=broad-except
+                errors.append(e)
 
-                if enumerate_owners:
-                    self.action_enumerate_owners(item)
+            while True:
+                entry = q.get()
+                try:
+                    if entry is None:
+                        return
+                    # after an error, drain the queue without processing so q.join() returns
+                    if not errors:
+                        self.process(q.put, *entry)
+                except Exception as e:  # pylint: disable=broad-except
+                    errors.append(e)
+                finally:
+                    q.task_done()
 
-                print(" | ".join(self.output_buffer.values()))
-                print("\033[1A", end="\x1b[2K")
-            except HttpError as e:
-                print()
-                print(f'Error on file {os.path.join(folder_name, item["name"])}.')
-                print()
-                raise e
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
+        # children are enqueued before their parent is marked done, so once every task is done
+        # there is nothing left anywhere in the tree (unlike checking q.empty() while workers run)
+        q.join()
+        for _ in threads:
+            q.put(None)
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+    def apply(self, plan):
+        """
+        Execute a plan.Plan: create its folders a level at a time, each level's folders in
+        parallel, then its moves as batch requests spread over self.workers threads
+        """
+
+        def init_worker():
+            self._local.drive = self._drive.clone()
+
+        def create(folder_id):
+            parent, name = plan.folders[folder_id]
+            # looked up first, so that applying a plan again doesn't duplicate folders
+            return self.resolve_folder(
+                Item(folder_id, name, FOLDER_MIME_TYPE), ids.get(parent, parent)
+            )[0]
+
+        # planned folder id -> id of the folder created for it
+        ids = {}
+        self.progress.total = len(plan.moves)
+        self.progress.start()
+        try:
+            with ThreadPoolExecutor(self.workers, initializer=init_worker) as pool:
+                for level in plan.levels():
+                    for folder_id, created_id in zip(level, pool.map(create, level)):
+                        ids[folder_id] = created_id
+                    self.status("folder", f"Created {len(ids)} of {len(plan.folders)} folders")
+
+                moves = [
+                    (
+                        Item(file_id, os.path.basename(path), None),
+                        from_parent,
+                        ids.get(to_folder, to_folder),
+                        path,
+                    )
+                    for path, file_id, from_parent, to_folder in plan.moves
+                ]
+                chunks = [moves[i : i + BATCH_SIZE] for i in range(0, len(moves), BATCH_SIZE)]
+                for chunk, _ in zip(chunks, pool.map(self.send_moves, chunks)):
+                    self.progress.add(done=len(chunk))
+        finally:
+            self.progress.stop()
+
+        for file_id, owners, link in plan.owners:
+            self.record_owners(file_id, owners, link)
+        print(f"Applied plan: {plan.summary()}")
+
+    def set_actions(self, move_files, enumerate_owners, copy_files=False):
+        """Select the actions to run on files, and so the file attributes to list"""
+        self.move_files = move_files
+        self.copy_files = copy_files
+        self.enumerate_owners = enumerate_owners
+        self.fields = "id, mimeType, name"
+        if enumerate_owners:
+            self.fields += ", owners, webViewLink"
+        if copy_files:
+            self.fields += f", {CONTENT_FIELDS}"
+
+    def walk(self, source_root, dest_root, changes_token=None, entries=None):
+        """
+        Run the selected actions on the tree of source_root, reproducing its folders in dest_root.
+        If changes_token is given, only act on what changed since it was obtained. If `entries`
+        are given, only act on those queue entries (e.g. a few subtrees of source_root)
+        """
+        if self.use_index:
+            self.build_index(source_root)
+            self.index_destination(dest_root)
+
+        if entries is None and changes_token:
+            entries, self.changes_token = self.changed_entries(
+                source_root, dest_root, changes_token
+            )
+            self.progress.message(
+                f"{len(entries)} changed files and folders under the source since the last sync"
+            )
+
+        if self.depth_first:
+            if entries is None:
+                entries = self.children("/", source_root, dest_root)
+            self.walk_depth_first(iter(entries))
+        else:
+            q = queue.Queue()
+            if entries is not None:
+                for entry in entries:
+                    q.put(entry)
+            elif self.journal and self.journal.resuming:
+                self.resume(q.put)
+            else:
+                self.list_folder("/", source_root, dest_root, q.put)
+
+            if self.workers > 1:
+                self.run_concurrent(q)
+            else:
+                while not q.empty():
+                    self.process(q.put, *q.get())
+
+        self.flush_moves()
+        self.flush_permissions()
+
+    # pylint: disable=too-many-arguments
+    def run(
+        self,
+        source_root,
+        dest_root,
+        move_files,
+        enumerate_owners,
+        changes_token=None,
+        copy_files=False,
+    ):
+        """
+        Run the specified action on dest_root, reproducing the directory structure of source_root.
+        If changes_token is given, only act on what changed since it was obtained
+        """
+        self.set_actions(move_files, enumerate_owners, copy_files)
+        self.progress.start()
+        try:
+            self.walk(source_root, dest_root, changes_token)
+        finally:
+            self.progress.stop()
+        self.report()
 
-        if self.owners:
-            print(self.owners)
+    def results(self):
+        """Return the outcome of the actions, for merge_results() in another process"""
+        with self.lock:
+            return {
+                "list_calls": self.list_calls,
+                "copied": self.copied,
+                "copies_up_to_date": self.copies_up_to_date,
+                "copy_errors": dict(self.copy_errors),
+                "permission_calls_avoided": self.permission_calls_avoided,
+                "throttled": self.throttled + self._drive.limiter.throttled,
+                "no_owners": set(self.no_owners),
+                "insufficient_permissions": set(self.insufficient_permissions),
+                "abandoned": dict(self.abandoned),
+            }
+
+    def merge_results(self, results):
+        """Add the results() of another Runner to this one's"""
+        with self.lock:
+            self.list_calls += results["list_calls"]
+            self.copied += results["copied"]
+            self.copies_up_to_date += results["copies_up_to_date"]
+            self.copy_errors.update(results["copy_errors"])
+            self.permission_calls_avoided += results["permission_calls_avoided"]
+            self.throttled += results["throttled"]
+            self.no_owners |= results["no_owners"]
+            self.insufficient_permissions |= results["insufficient_permissions"]
+            self.abandoned.update(results["abandoned"])
+
+    def report(self):
+        """Print the outcome of the actions"""
+        if self.index is None:
+            print(f"Listing the source tree took {self.list_calls} files.list calls")
+
+        if self.copy_files:
+            print(f"Copied {self.copied} files, {self.copies_up_to_date} copies were up to date")
+        if self.copy_errors:
+            print(f"Could not copy: {self.copy_errors}")
+        if self.abandoned:
+            print(
+                "Files may be left in these folders, whose listing kept returning files already"
+                f" moved: {self.abandoned}"
+            )
+        if self.listed_owners and self.enumerate_owners:
+            print(
+                f"Took owners from listing data for {self.permission_calls_avoided} files, "
+                f"avoiding as many permissions.list calls"
+            )
+        throttled = self.throttled + self._drive.limiter.throttled
+        if throttled:
+            print(f"Requests were rate limited {throttled} times")
+        if self.no_owners:
+            print(f"Files without an owner (e.g. in a shared drive): {self.no_owners}")
+        counts = self.owner_index.counts() if self.enumerate_owners else None
+        if counts:
+            print(f"Files per owner: {dict(counts)}")
         if self.insufficient_permissions:
             print(
                 f"Did not have sufficient permissions to operate on files: {self.insufficient_permissions}"
             )
 
 
+def load_sync_state(filename, source_root, dest_root):
+    """Return the changes token saved by save_sync_state for this source and destination"""
+    with open(filename, "r", encoding="utf-8") as f:
+        state = json.load(f)
+    if (state["source"], state["dest"]) != (source_root, dest_root):
+        raise ValueError(
+            f'{filename} is for {state["source"]} -> {state["dest"]}, '
+            f"not {source_root} -> {dest_root}"
+        )
+    return state["start_page_token"]
+
+
+def save_sync_state(filename, source_root, dest_root, token):
+    with open(filename, "w", encoding="utf-8") as f:
+        json.dump({"source": source_root, "dest": dest_root, "start_page_token": token}, f)
+
+
+def run_shard(number, options, tasks, results):
+    """
+    Body of the processes started by run_sharded: act on each list of queue entries taken from
+    `tasks` until None, then put (number, results, metrics snapshot, error) on `results`
+    """
+    runner = None
+    error = None
+    try:
+        creds = None
+        if options["token_file"]:
+            creds = Credentials.from_authorized_user_file(options["token_file"], SCOPES)
+        # refreshed in memory only: the coordinator owns the token files
+        credentials = CredentialsManager(creds).start()
+        drive = DriveFiles(
+            credentials.credentials,
+            RateLimiter(options["max_qps"], max_concurrency=options["workers"]),
+            http_f=options["http_f"] or HttpPool(**options["transport"]),
+        )
+        owner_index = OwnerIndex(options["owner_index"]) if options["owner_index"] else None
+        runner = Runner(
+            drive,
+            None,
+            batch_moves=options["batch_moves"],
+            workers=options["workers"],
+            listed_owners=options["listed_owners"],
+            owner_index=owner_index,
+            progress=Progress(drive.metrics, options["progress_interval"], name=f"shard{number}"),
+            depth_first=options["depth_first"],
+        )
+        runner.set_actions(*options["actions"])
+        # dest_root as listed by run_sharded
+        runner.dest_folders.update(options["dest_folders"])
+        runner.dest_files.update(options["dest_files"])
+        runner.dest_listed.update(options["dest_listed"])
+        runner.progress.start()
+        try:
+            while True:
+                entries = tasks.get()
+                if entries is None:
+                    break
+                runner.walk(options["source"], options["dest"], entries=entries)
+        finally:
+            runner.progress.stop()
+            runner.close()
+            if owner_index:
+                owner_index.close()
+            credentials.stop()
+    except Exception:  # pylint: disable=broad-except
+        error = traceback.format_exc()
+    results.put(
+        (
+            number,
+            runner.results() if runner else None,
+            runner.drive.metrics.snapshot() if runner else None,
+            error,
+        )
+    )
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def run_sharded(runner, source_root, dest_root, shards, token_files=(), options=None):
+    """
+    Run the actions selected on `runner` (see Runner.set_actions) with `shards` processes, each
+    with its own GIL and, given several `token_files`, its own user's quota. The top-level folders
+    of source_root are handed out one name at a time to whichever process is free, after this
+    process has created their destination folders, so no two processes create the same folder.
+    The files directly in source_root make one more task. The processes' results, metrics and
+    owners are merged into `runner`. `options` are passed to run_shard, e.g. its "http_f", which
+    must survive pickling (e.g. fake_google.FakeServer.http, to run against a local fake)
+    """
+    children = list(runner.listdir(source_root))
+    tasks = {}
+    # handed to the processes, which would otherwise look them up again by listing dest_root,
+    # where a folder just created may not show up yet
+    dest_folders = {}
+    for item in children:
+        if item.is_folder:
+            dest_folders[(dest_root, item.name)], _ = runner.resolve_folder(item, dest_root)
+            tasks.setdefault(item.name, []).append(("/", item, source_root, dest_root))
+    tasks = list(tasks.values())
+    root_files = [("/", item, source_root, dest_root) for item in children if not item.is_folder]
+    if root_files:
+        tasks.append(root_files)
+    print(f"Sharding {len(tasks)} tasks between {shards} processes")
+
+    token_files = list(token_files) or [None]
+    tokens = [token_files[number % len(token_files)] for number in range(shards)]
+    options = {
+        "source": source_root,
+        "dest": dest_root,
+        "actions": (runner.move_files, runner.enumerate_owners, runner.copy_files),
+        "batch_moves": runner.batch_moves,
+        "workers": runner.workers,
+        "listed_owners": runner.listed_owners,
+        "depth_first": runner.depth_first,
+        "max_qps": runner.drive.limiter.rate,
+        "transport": {},
+        "http_f": None,
+        "progress_interval": None,
+        **(options or {}),
+        "dest_folders": dest_folders,
+        # copies of the files directly in source_root, listed along with dest_root's folders
+        "dest_files": {key: copy for key, copy in runner.dest_files.items() if key[0] == dest_root},
+        "dest_listed": runner.dest_listed & {dest_root},
+    }
+
+    context = multiprocessing.get_context("spawn")
+    task_queue = context.Queue()
+    result_queue = context.Queue()
+    for entries in tasks:
+        task_queue.put(entries)
+    with tempfile.TemporaryDirectory() as tmp:
+        processes = []
+        for number, token_file in enumerate(tokens):
+            shard_options = {
+                **options,
+                "token_file": token_file,
+                # processes using the same token share its user's quota
+                "max_qps": options["max_qps"] / tokens.count(token_file),
+                "owner_index": (
+                    os.path.join(tmp, f"owners-{number}.db") if runner.enumerate_owners else None
+                ),
+            }
+            task_queue.put(None)
+            process = context.Process(
+                target=run_shard,
+                args=(number, shard_options, task_queue, result_queue),
+                name=f"shard{number}",
+            )
+            process.start()
+            processes.append(process)
+
+        errors = []
+        reported = set()
+        while len(reported) < shards:
+            try:
+                number, results, snapshot, error = result_queue.get(timeout=1)
+            except queue.Empty:
+                if all(process.exitcode is not None for process in processes):
+                    errors.extend(
+                        f"shard{number} exited without reporting"
+                        for number in range(shards)
+                        if number not in reported
+                    )
+                    break
+                continue
+            reported.add(number)
+            if results:
+                runner.merge_results(results)
+                runner.drive.metrics.merge(snapshot)
+            if error:
+                errors.append(f"shard{number} failed:\n{error}")
+        for process in processes:
+            process.join()
+        # tasks left by failed processes must not keep this one from exiting
+        task_queue.cancel_join_thread()
+
+        if runner.enumerate_owners:
+            for number in sorted(reported):
+                filename = os.path.join(tmp, f"owners-{number}.db")
+                if os.path.exists(filename):
+                    runner.owner_index.merge(filename)
+            if runner.owners_writer:
+                runner.owners_writer.writerows(runner.owner_index.entries())
+
+    if errors:
+        raise RuntimeError("\n".join(errors))
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -287,37 +1618,257 @@ def parse_args():
         help="Attempt to move files to corresponding folder in <dest>",
         action="store_true",
     )
+    parser.add_argument(
+        "--copy-files",
+        help=(
+            "Copy files to the corresponding folder in <dest>, e.g. for files which can't be moved."
+            " Files whose copy is up to date (same checksum, or size and modified time) are skipped"
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--batch-moves",
+        help=f"Send moves as batch requests of up to {BATCH_SIZE} files rather than one at a time",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--index",
+        help=(
+            "List the whole source corpus up front with a few large queries instead of one query"
+            " per folder. Faster for deep trees with few files per folder"
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--max-qps",
+        help=f"Maximum Drive requests per second, shared by all workers (default {DRIVE_QPS})",
+        type=float,
+        default=DRIVE_QPS,
+    )
+    parser.add_argument(
+        "--journal",
+        help="SQLite file recording progress, so an interrupted run can be continued with --resume",
+    )
+    parser.add_argument(
+        "--resume",
+        help="Continue the run recorded in --journal, skipping the work it completed",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--sync-state",
+        help="JSON file in which to save a Drive changes token after each run, for --incremental",
+    )
+    parser.add_argument(
+        "--incremental",
+        help=(
+            "Only act on files changed under <source> since the run which wrote --sync-state,"
+            " using the Drive changes feed instead of walking the tree"
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--plan",
+        help=(
+            "Walk the source and destination without changing anything and write what would be"
+            " done to this file, for review or diffing with an earlier plan"
+        ),
+    )
+    parser.add_argument(
+        "--apply",
+        help="Execute a plan written by --plan, creating folders level by level then moving files",
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of threads listing folders and acting on files concurrently (default 1)",
+        type=int,
+        default=1,
+    )
     parser.add_argument(
         "--list-owners",
         help="Enumerate owners of all files under <source>",
         action="store_true",
     )
+    parser.add_argument(
+        "--listed-owners",
+        help=(
+            "With --list-owners, use the owners returned when listing folders and only call"
+            " permissions.list (batched) for files without any, e.g. in shared drives"
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--owner-index",
+        help=(
+            "SQLite file in which --list-owners records owners, read by compose_emails.py"
+            " (default ./owners.db)"
+        ),
+        default=os.path.join(os.getcwd(), "owners.db"),
+    )
     parser.add_argument(
         "-o",
         "--owners-file",
         help="CSV for storing list of owners (can run long)",
         type=argparse.FileType("w"),
     )
+    parser.add_argument(
+        "--depth-first",
+        help=(
+            "Walk the source depth-first, listing each folder a page at a time as the walk reaches"
+            " it, instead of breadth-first. Memory use then grows with the depth of the tree rather"
+            " than its width; folders are listed by one thread"
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--shards",
+        help=(
+            "Split the top-level folders of the source between this many processes, each running"
+            " --workers threads. Scales past one CPU and, with --shard-tokens, one user's quota"
+        ),
+        type=int,
+    )
+    parser.add_argument(
+        "--shard-tokens",
+        help=(
+            "Token files for the --shards processes to use in turn, e.g. one per Google account"
+            " (default ./token.json for all). Missing ones are created by signing in first"
+        ),
+        nargs="+",
+    )
+    parser.add_argument(
+        "--progress-interval",
+        help=(
+            "Seconds between progress updates (default: 0.25 on a terminal; otherwise 10, as"
+            " key=value log lines)"
+        ),
+        type=float,
+    )
+    add_metrics_arguments(parser)
+    add_transport_arguments(parser)
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.resume and not args.journal:
+        parser.error("--resume requires --journal")
+    if args.incremental and not args.sync_state:
+        parser.error("--incremental requires --sync-state")
+    if args.incremental and (args.journal or args.index):
+        parser.error("--incremental can't be combined with --journal or --index")
+    if args.move_files and args.copy_files:
+        parser.error("--move-files and --copy-files are mutually exclusive")
+    if args.plan and (args.apply or args.journal or args.sync_state or args.copy_files):
+        parser.error(
+            "--plan can't be combined with --apply, --journal, --sync-state or --copy-files"
+        )
+    if args.apply and (args.journal or args.sync_state or args.incremental):
+        parser.error("--apply can't be combined with --journal, --sync-state or --incremental")
+    if args.depth_first and args.journal:
+        parser.error("--depth-first can't be combined with --journal")
+    if args.shard_tokens and not args.shards:
+        parser.error("--shard-tokens requires --shards")
+    if args.shards and (args.plan or args.apply or args.journal or args.incremental or args.index):
+        parser.error(
+            "--shards can't be combined with --plan, --apply, --journal, --incremental or --index"
+        )
+
+    return args
 
 
 def main():
     args = parse_args()
 
-    if not (args.move_files or args.list_owners):
+    if not (args.move_files or args.copy_files or args.list_owners or args.apply):
         print("Warning: no actions specified. Directory structure will simply be copied")
 
     from_id = os.path.basename(args.source)
     to_id = os.path.basename(args.dest)
+    plan = None
+    if args.apply:
+        plan = Plan.load(args.apply)
+        if (plan.source, plan.dest) != (from_id, to_id):
+            raise ValueError(f"{args.apply} is a plan for {plan.source} -> {plan.dest}")
+    elif args.plan:
+        plan = Plan(from_id, to_id)
     user_credentials = os.path.join(os.getcwd(), "token.json")
+    credentials = CredentialsManager(
+        authenticate(user_credentials, args.app_credentials.name), user_credentials
+    ).start()
 
-    def generate_creds():
-        return authenticate(user_credentials, args.app_credentials.name)
+    drive = DriveFiles(
+        credentials.credentials,
+        RateLimiter(args.max_qps, max_concurrency=args.workers),
+        metrics_from_args(args),
+        transport_from_args(args, args.workers),
+    )
+    journal = Journal(args.journal, from_id, to_id, resume=args.resume) if args.journal else None
+    owner_index = None
+    if (args.list_owners and not args.plan) or (args.apply and plan.owners):
+        # a full run starts over, as owners may have changed since the index was written
+        owner_index = OwnerIndex(args.owner_index, reset=not (args.resume or args.incremental))
+    runner = Runner(
+        drive,
+        args.owners_file.name if args.owners_file else None,
+        batch_moves=args.batch_moves,
+        workers=args.workers,
+        use_index=args.index,
+        journal=journal,
+        listed_owners=args.listed_owners,
+        owner_index=owner_index,
+        plan=plan if args.plan else None,
+        progress=Progress(drive.metrics, args.progress_interval),
+        depth_first=args.depth_first,
+    )
+    try:
+        if args.apply:
+            runner.apply(plan)
+        elif args.incremental:
+            token = load_sync_state(args.sync_state, from_id, to_id)
+            runner.run(
+                from_id,
+                to_id,
+                args.move_files,
+                args.list_owners,
+                changes_token=token,
+                copy_files=args.copy_files,
+            )
+            token = runner.changes_token
+        elif args.shards:
+            token = runner.start_changes(from_id) if args.sync_state else None
+            # signed in here, so that shard processes never wait for a browser
+            for token_file in args.shard_tokens or ():
+                authenticate(token_file, args.app_credentials.name)
+            runner.set_actions(args.move_files, args.list_owners, args.copy_files)
+            run_sharded(
+                runner,
+                from_id,
+                to_id,
+                args.shards,
+                args.shard_tokens or [user_credentials],
+                {
+                    "transport": transport_options(args, args.workers),
+                    "progress_interval": args.progress_interval,
+                },
+            )
+            runner.report()
+        else:
+            # taken before walking so that changes made during the walk are seen next time
+            token = runner.start_changes(from_id) if args.sync_state else None
+            runner.run(
+                from_id, to_id, args.move_files, args.list_owners, copy_files=args.copy_files
+            )
 
-    drive = DriveFiles(generate_creds)
-    runner = Runner(drive, args.owners_file.name if args.owners_file else None)
-    runner.run(from_id, to_id, args.move_files, args.list_owners)
+        if args.plan:
+            plan.save(args.plan)
+            print(f"Wrote plan to {args.plan}: {plan.summary()}")
+        if args.sync_state:
+            save_sync_state(args.sync_state, from_id, to_id, token)
+    finally:
+        credentials.stop()
+        drive.http_f.close()
+        runner.close()
+        if journal:
+            journal.close()
+        if owner_index:
+            owner_index.close()
 
 
 if __name__ == "__main__":
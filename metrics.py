@@ -0,0 +1,252 @@
+"""Per API method call counts, latencies, bytes received, retries and errors"""
+
+import atexit
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from ssl import SSLEOFError
+
+from googleapiclient.errors import HttpError
+
+from ratelimit import error_reasons
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PROMETHEUS_PREFIX = "gdrive_migration_api"
+
+
+def error_class(error):
+    """Short label for an error: status and reason for HttpErrors, the type name otherwise"""
+    if isinstance(error, HttpError):
+        reasons = sorted(filter(None, error_reasons(error)))
+        return ":".join([str(error.resp.status), *reasons[:1]])
+    if isinstance(error, SSLEOFError):
+        return "SSLEOFError"
+    return type(error).__name__
+
+
+class MethodStats:
+    __slots__ = (
+        "calls",
+        "retries",
+        "bytes_received",
+        "errors",
+        "latency_sum",
+        "latency_count",
+        "latency_buckets",
+    )
+
+    def __init__(self):
+        self.calls = 0
+        self.retries = 0
+        self.bytes_received = 0
+        self.errors = {}
+        self.latency_sum = 0.0
+        self.latency_count = 0
+        # non-cumulative counts per bucket, the last one being +Inf
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def to_dict(self):
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip((*LATENCY_BUCKETS, "+Inf"), self.latency_buckets):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "bytes_received": self.bytes_received,
+            "errors": dict(self.errors),
+            "latency_seconds": {
+                "sum": self.latency_sum,
+                "count": self.latency_count,
+                "buckets": buckets,
+            },
+        }
+
+
+class Metrics:
+    """
+    Thread-safe registry of MethodStats keyed by API method id (e.g. drive.files.list), which can
+    be written as JSON and as a Prometheus textfile
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = {}
+        self.started = time.time()
+
+    def _stats(self, method):
+        stats = self.methods.get(method)
+        if stats is None:
+            stats = self.methods[method] = MethodStats()
+        return stats
+
+    def record(self, method, seconds=None, error=None):
+        """Count one call of `method`, with its latency if it was a request of its own"""
+        with self.lock:
+            stats = self._stats(method)
+            stats.calls += 1
+            if seconds is not None:
+                stats.latency_sum += seconds
+                stats.latency_count += 1
+                index = next(
+                    (i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound),
+                    len(LATENCY_BUCKETS),
+                )
+                stats.latency_buckets[index] += 1
+            if error is not None:
+                label = error_class(error)
+                stats.errors[label] = stats.errors.get(label, 0) + 1
+
+    def total_calls(self):
+        """Return the number of calls of all methods"""
+        with self.lock:
+            return sum(stats.calls for stats in self.methods.values())
+
+    def retry(self, method):
+        with self.lock:
+            self._stats(method).retries += 1
+
+    def add_bytes(self, method, count):
+        with self.lock:
+            self._stats(method).bytes_received += count
+
+    def instrument(self, request):
+        """Make googleapiclient `request` count the bytes of its response; returns request"""
+        method = request.methodId
+        postproc = request.postproc
+
+        def counting_postproc(resp, content):
+            self.add_bytes(method, len(content))
+            return postproc(resp, content)
+
+        request.postproc = counting_postproc
+        return request
+
+    @contextmanager
+    def timed(self, method):
+        """Record a call of `method` taking as long as the body of the with statement"""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.record(method, time.perf_counter() - start, e)
+            raise
+        self.record(method, time.perf_counter() - start)
+
+    def execute(self, request, **kwargs):
+        """Execute googleapiclient `request`, recording it"""
+        self.instrument(request)
+        with self.timed(request.methodId):
+            return request.execute(**kwargs)
+
+    def snapshot(self):
+        with self.lock:
+            methods = {method: stats.to_dict() for method, stats in sorted(self.methods.items())}
+        return {"uptime_seconds": time.time() - self.started, "methods": methods}
+
+    def merge(self, snapshot):
+        """Add the calls of another Metrics' snapshot() (e.g. from another process) to these"""
+        with self.lock:
+            for method, other in snapshot["methods"].items():
+                stats = self._stats(method)
+                stats.calls += other["calls"]
+                stats.retries += other["retries"]
+                stats.bytes_received += other["bytes_received"]
+                for label, count in other["errors"].items():
+                    stats.errors[label] = stats.errors.get(label, 0) + count
+                latency = other["latency_seconds"]
+                stats.latency_sum += latency["sum"]
+                stats.latency_count += latency["count"]
+                # snapshot buckets are cumulative
+                previous = 0
+                for i, cumulative in enumerate(latency["buckets"].values()):
+                    stats.latency_buckets[i] += cumulative - previous
+                    previous = cumulative
+
+    def prometheus(self):
+        """Render the metrics in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+
+        def family(name, kind, description):
+            lines.append(f"# HELP {PROMETHEUS_PREFIX}_{name} {description}")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} {kind}")
+
+        def sample(name, labels, value):
+            label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+            lines.append(f"{PROMETHEUS_PREFIX}_{name}{{{label_text}}} {value}")
+
+        methods = snapshot["methods"]
+        family("calls_total", "counter", "API calls, including each sub-request of a batch")
+        for method, stats in methods.items():
+            sample("calls_total", {"method": method}, stats["calls"])
+        family("retries_total", "counter", "API calls retried after a transient error")
+        for method, stats in methods.items():
+            sample("retries_total", {"method": method}, stats["retries"])
+        family("received_bytes_total", "counter", "Bytes of API response bodies")
+        for method, stats in methods.items():
+            sample("received_bytes_total", {"method": method}, stats["bytes_received"])
+        family("errors_total", "counter", "Failed API calls by error class")
+        for method, stats in methods.items():
+            for error, count in sorted(stats["errors"].items()):
+                sample("errors_total", {"method": method, "error": error}, count)
+        family("latency_seconds", "histogram", "API request latency")
+        for method, stats in methods.items():
+            latency = stats["latency_seconds"]
+            for bound, count in latency["buckets"].items():
+                sample("latency_seconds_bucket", {"method": method, "le": bound}, count)
+            sample("latency_seconds_sum", {"method": method}, latency["sum"])
+            sample("latency_seconds_count", {"method": method}, latency["count"])
+        return "\n".join(lines) + "\n"
+
+    def write(self, json_file=None, prometheus_file=None):
+        """Write the metrics to the given files, atomically so readers never see partial files"""
+        for filename, render in (
+            (json_file, lambda: json.dumps(self.snapshot(), indent=2)),
+            (prometheus_file, self.prometheus),
+        ):
+            if not filename:
+                continue
+            tmp = f"{filename}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(render())
+            os.replace(tmp, filename)
+
+    def export(self, json_file=None, prometheus_file=None, interval=60):
+        """Write the metrics every `interval` seconds from a background thread, and on exit"""
+        if not (json_file or prometheus_file):
+            return
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.write(json_file, prometheus_file)
+
+        threading.Thread(target=loop, daemon=True).start()
+        atexit.register(self.write, json_file, prometheus_file)
+
+
+def add_metrics_arguments(parser):
+    """Add the metrics export options used by metrics_from_args to argparse `parser`"""
+    parser.add_argument("--metrics-json", help="File to write API call metrics to as JSON")
+    parser.add_argument(
+        "--metrics-prom",
+        help="File to write API call metrics to in the Prometheus textfile format",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        help="Seconds between metrics file updates during the run (default 60)",
+        type=float,
+        default=60,
+    )
+
+
+def metrics_from_args(args):
+    """Return a Metrics exported as requested by the add_metrics_arguments options in `args`"""
+    metrics = Metrics()
+    metrics.export(args.metrics_json, args.metrics_prom, args.metrics_interval)
+    return metrics
@@ -0,0 +1,94 @@
+"""
+Owners of the files of a source tree, written by main.py --list-owners as it goes and read by
+compose_emails.py, without either holding all of it in memory
+"""
+
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS owners (
+    owner TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    link TEXT,
+    PRIMARY KEY (owner, file_id)
+) WITHOUT ROWID;
+"""
+
+# commit at least this often (seconds) while writing
+COMMIT_INTERVAL = 1.0
+
+
+class OwnerIndex:
+    """
+    SQLite table of (owner, file id, link), with per-owner file counts and links. An empty
+    `filename` gives a private temporary database, deleted on close. `reset` empties an existing
+    index. Safe to share between threads
+    """
+
+    def __init__(self, filename="", reset=False):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        if filename:
+            self.db.execute("PRAGMA journal_mode = WAL")
+            self.db.execute("PRAGMA synchronous = NORMAL")
+        if reset:
+            self.db.execute("DROP TABLE IF EXISTS owners")
+        self.db.executescript(SCHEMA)
+        self._last_commit = time.monotonic()
+
+    def add(self, file_id, owners, link):
+        """Record the owners of a file, returning those which were not recorded yet"""
+        with self.lock:
+            new = [
+                owner
+                for owner in owners
+                if self.db.execute(
+                    "INSERT OR IGNORE INTO owners VALUES (?, ?, ?)", (owner, file_id, link)
+                ).rowcount
+            ]
+            if time.monotonic() - self._last_commit > COMMIT_INTERVAL:
+                self.db.commit()
+                self._last_commit = time.monotonic()
+        return new
+
+    def counts(self):
+        """Return [(owner, number of files), ...] for every owner, in owner order"""
+        with self.lock:
+            self.db.commit()
+            return self.db.execute("SELECT owner, COUNT(*) FROM owners GROUP BY owner").fetchall()
+
+    def links(self, owner, limit=-1):
+        """Return the links of up to `limit` (default all) of the files of `owner`"""
+        with self.lock:
+            return [
+                link
+                for (link,) in self.db.execute(
+                    "SELECT link FROM owners WHERE owner = ? LIMIT ?", (owner, limit)
+                )
+            ]
+
+    def entries(self):
+        """Yield (owner, link) for every file of every owner, in owner order, while nothing is added"""
+        with self.lock:
+            self.db.commit()
+            rows = self.db.execute("SELECT owner, link FROM owners ORDER BY owner, file_id")
+        yield from rows
+
+    def merge(self, filename):
+        """Add the entries of the index in `filename`, e.g. written by another process"""
+        with self.lock:
+            self.db.commit()
+            self.db.execute("ATTACH DATABASE ? AS other", (filename,))
+            try:
+                self.db.execute("INSERT OR IGNORE INTO owners SELECT * FROM other.owners")
+                self.db.commit()
+            finally:
+                self.db.execute("DETACH DATABASE other")
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
@@ -0,0 +1,115 @@
+"""
+Migration plans: what main.py --plan found to do, saved for review and executed by --apply. A plan
+is a JSON Lines file with a header line followed by one action per line in a stable order, so two
+plans of the same tree can be compared with diff
+"""
+
+import json
+import threading
+
+# prefix of the ids standing for destination folders which the plan creates
+NEW_PREFIX = "new:"
+VERSION = 1
+
+
+def is_planned(folder_id):
+    return folder_id.startswith(NEW_PREFIX)
+
+
+def path_segment(name):
+    """Escape folder `name` for use in a planned id, so that "a/b" and "a" then "b" differ"""
+    return name.replace("%", "%25").replace("/", "%2F")
+
+
+class Plan:
+    """
+    Actions recorded while walking a tree without changing it. Folders to create are given ids
+    spelling their destination path (new:<existing parent id>/<name>/..., see path_segment), which
+    move actions and child folders refer to. Safe to share between threads
+    """
+
+    def __init__(self, source, dest):
+        self.source = source
+        self.dest = dest
+        self.lock = threading.Lock()
+        # planned id -> (parent id, name)
+        self.folders = {}
+        # (path, file id, from parent id, to folder id)
+        self.moves = []
+        # (file id, owners, link)
+        self.owners = []
+
+    def mkdir(self, parent, name):
+        """Plan the creation of folder `name` in `parent`, returning the planned folder's id"""
+        segment = path_segment(name)
+        folder_id = (
+            f"{parent}/{segment}" if is_planned(parent) else f"{NEW_PREFIX}{parent}/{segment}"
+        )
+        with self.lock:
+            self.folders[folder_id] = (parent, name)
+        return folder_id
+
+    def move(self, path, file_id, from_parent, to_folder):
+        with self.lock:
+            self.moves.append((path, file_id, from_parent, to_folder))
+
+    def add_owners(self, file_id, owners, link):
+        with self.lock:
+            self.owners.append((file_id, sorted(owners), link))
+
+    def levels(self):
+        """Return the planned folder ids grouped so that each group's parents are in earlier ones"""
+        levels = {}
+        for folder_id in self.folders:
+            depth = 0
+            parent = folder_id
+            while is_planned(parent):
+                parent = self.folders[parent][0]
+                depth += 1
+            levels.setdefault(depth, []).append(folder_id)
+        return [sorted(levels[depth]) for depth in sorted(levels)]
+
+    def summary(self):
+        return (
+            f"{len(self.folders)} folders to create, {len(self.moves)} files to move, "
+            f"owners of {len(self.owners)} files"
+        )
+
+    def save(self, filename):
+        with self.lock, open(filename, "w", encoding="utf-8") as f:
+            header = {"version": VERSION, "source": self.source, "dest": self.dest}
+            f.write(json.dumps(header) + "\n")
+            for folder_id, (parent, name) in sorted(self.folders.items()):
+                action = {"action": "mkdir", "id": folder_id, "parent": parent, "name": name}
+                f.write(json.dumps(action) + "\n")
+            for path, file_id, from_parent, to_folder in sorted(self.moves):
+                action = {
+                    "action": "move",
+                    "path": path,
+                    "id": file_id,
+                    "from": from_parent,
+                    "to": to_folder,
+                }
+                f.write(json.dumps(action) + "\n")
+            for file_id, owners, link in sorted(self.owners):
+                action = {"action": "owners", "id": file_id, "owners": owners, "link": link}
+                f.write(json.dumps(action) + "\n")
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, encoding="utf-8") as f:
+            header = json.loads(f.readline())
+            if header.get("version") != VERSION:
+                raise ValueError(f"{filename} is not a version {VERSION} plan")
+            plan = cls(header["source"], header["dest"])
+            for line in f:
+                action = json.loads(line)
+                if action["action"] == "mkdir":
+                    plan.folders[action["id"]] = (action["parent"], action["name"])
+                elif action["action"] == "move":
+                    plan.move(action["path"], action["id"], action["from"], action["to"])
+                elif action["action"] == "owners":
+                    plan.add_owners(action["id"], action["owners"], action["link"])
+                else:
+                    raise ValueError(f"Unknown action in {filename}: {line}")
+        return plan
@@ -0,0 +1,198 @@
+"""
+Progress display for main.py, redrawn by its own thread at a fixed rate rather than by every
+worker after every file. On a terminal it is a single status line; otherwise (e.g. when output is
+redirected to a log file) it is a structured key=value line every few seconds
+"""
+
+import json
+import shutil
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+# seconds between redraws of the status line on a terminal, and between log lines otherwise
+TTY_INTERVAL = 0.25
+LOG_INTERVAL = 10.0
+# rates are averaged over this many seconds
+RATE_WINDOW = 10.0
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class Progress:
+    """
+    Counts of folders listed, files found and files done, and status messages set by key (e.g. the
+    current folder), rendered with the rate of files done, of API calls (from `metrics`) and the
+    time left when `total`, the number of files expected, is known. A `name` (e.g. of a shard, when
+    several processes share the terminal) is added to the fields, and selects log lines. Safe to
+    share between threads
+    """
+
+    def __init__(self, metrics=None, interval=None, stream=None, name=None):
+        self.metrics = metrics
+        self.interval = interval
+        self.name = name
+        # sys.stdout at the time of writing unless given
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.folders = 0
+        self.files = 0
+        self.done = 0
+        self.total = None
+        self.messages = {}
+        self.started = time.monotonic()
+        # (time, files done, API calls) of the last RATE_WINDOW seconds
+        self._samples = deque()
+        self._stop = threading.Event()
+        self._thread = None
+        self._tty = False
+        # whether a status line is on screen, to be cleared before writing anything else
+        self._drawn = False
+
+    @property
+    def out(self):
+        return self.stream or sys.stdout
+
+    def add(self, folders=0, files=0, done=0):
+        with self.lock:
+            self.folders += folders
+            self.files += files
+            self.done += done
+
+    def restore(self, done):
+        """Count `done` files found and done by an earlier run, leaving the rates unchanged"""
+        with self.lock:
+            self.files += done
+            self.done += done
+            self._samples = deque(
+                (then, count + done, calls) for then, count, calls in self._samples
+            )
+
+    def status(self, key, message):
+        """Set the status entry `key` to `message`, or remove it if message is None"""
+        with self.lock:
+            if message is None:
+                self.messages.pop(key, None)
+            else:
+                self.messages[key] = message
+
+    def _api_calls(self):
+        return self.metrics.total_calls() if self.metrics else 0
+
+    def _rates(self, now):
+        """Return (files done per second, API calls per second) over the last RATE_WINDOW"""
+        self._samples.append((now, self.done, self._api_calls()))
+        while now - self._samples[0][0] > RATE_WINDOW and len(self._samples) > 2:
+            self._samples.popleft()
+        then, done, calls = self._samples[0]
+        elapsed = now - then
+        if elapsed <= 0:
+            return 0.0, 0.0
+        return (self.done - done) / elapsed, (self._samples[-1][2] - calls) / elapsed
+
+    def fields(self):
+        """Return the current progress as a dict"""
+        now = time.monotonic()
+        with self.lock:
+            items_rate, calls_rate = self._rates(now)
+            fields = {
+                "name": self.name,
+                "folders": self.folders,
+                "files": self.files,
+                "done": self.done,
+                "total": self.total,
+                "items_per_s": round(items_rate, 1),
+                "api_calls_per_s": round(calls_rate, 1),
+                "eta_s": None,
+                "elapsed_s": round(now - self.started),
+            }
+            if self.total is not None and items_rate > 0:
+                fields["eta_s"] = round(max(self.total - self.done, 0) / items_rate)
+            fields["status"] = " | ".join(self.messages.values())
+        return fields
+
+    def line(self):
+        """Return the one-line summary shown on a terminal"""
+        fields = self.fields()
+        done = f"{fields['done']}" + (f"/{fields['total']}" if fields["total"] is not None else "")
+        parts = [
+            f"{fields['folders']} folders, {fields['files']} files, {done} done",
+            f"{fields['items_per_s']:.0f} files/s, {fields['api_calls_per_s']:.0f} calls/s",
+        ]
+        if fields["eta_s"] is not None:
+            parts.append(f"ETA {format_duration(fields['eta_s'])}")
+        if fields["status"]:
+            parts.append(fields["status"])
+        return " | ".join(parts)
+
+    def log_line(self):
+        """Return a structured key=value line, for logs"""
+        fields = {"time": datetime.now().isoformat(timespec="seconds"), **self.fields()}
+        return " ".join(
+            f"{key}={value if isinstance(value, (int, float)) else json.dumps(value)}"
+            for key, value in fields.items()
+            if value is not None and value != ""
+        )
+
+    def render(self):
+        if self._tty:
+            width = shutil.get_terminal_size().columns
+            # clipped to the terminal, as a wrapped line couldn't be cleared with \r
+            text = self.line()[: max(width - 1, 1)]
+            with self.lock:
+                self.out.write(f"\r\x1b[2K{text}")
+                self.out.flush()
+                self._drawn = True
+        else:
+            text = self.log_line()
+            with self.lock:
+                print(f"progress {text}", file=self.out, flush=True)
+
+    def message(self, *lines):
+        """Print `lines` (like print() for each), keeping the status line below them"""
+        with self.lock:
+            if self._drawn:
+                self.out.write("\r\x1b[2K")
+                self._drawn = False
+            for text in lines:
+                print(text, file=self.out)
+            self.out.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.render()
+
+    def start(self):
+        """Start rendering in the background"""
+        self._tty = self.name is None and self.out.isatty()
+        if self.interval is None:
+            self.interval = TTY_INTERVAL if self._tty else LOG_INTERVAL
+        self.started = time.monotonic()
+        # rates are from the start until RATE_WINDOW has passed
+        self._samples = deque([(self.started, self.done, self._api_calls())])
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="progress", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop rendering, leaving the final progress on screen or in the log"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.render()
+        if self._tty:
+            with self.lock:
+                self.out.write("\n")
+                self._drawn = False
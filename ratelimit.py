@@ -0,0 +1,120 @@
+"""Client-side rate control shared by every worker making Google API calls"""
+
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from ssl import SSLEOFError
+
+from googleapiclient.errors import HttpError
+
+# Drive allows 12,000 queries per minute per user
+DRIVE_QPS = 200
+# number of times a failed request is retried before giving up
+MAX_RETRIES = 8
+# backoff bounds (seconds)
+BACKOFF_BASE = 1
+BACKOFF_CAP = 64
+# default cap on requests in flight; more than the number of threads making requests is harmless
+MAX_CONCURRENCY = 32
+# reasons given on a 403 which mean "slow down" rather than "not allowed"
+RATE_LIMIT_REASONS = {"userRateLimitExceeded", "rateLimitExceeded"}
+# dropped connections and timeouts, after which the request may or may not have been carried out
+CONNECTION_ERRORS = (SSLEOFError, ConnectionError, TimeoutError)
+
+
+def error_reasons(error):
+    details = error.error_details if isinstance(error.error_details, list) else []
+    return {detail.get("reason") for detail in details if isinstance(detail, dict)}
+
+
+def is_rate_limited(error):
+    """Return True if `error` is Google telling us to slow down"""
+    if not isinstance(error, HttpError):
+        return False
+    status = error.resp.status
+    return status == 429 or (status == 403 and bool(error_reasons(error) & RATE_LIMIT_REASONS))
+
+
+def is_retryable(error):
+    """Return True if `error` is a transient HttpError (rate limiting or server side)"""
+    if not isinstance(error, HttpError):
+        return False
+    return is_rate_limited(error) or error.resp.status >= 500
+
+
+def retry_after(error):
+    """Return the delay in seconds requested by the Retry-After header of `error`, if any"""
+    value = error.resp.get("retry-after") if isinstance(error, HttpError) else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, error=None):
+    """Seconds to wait before retry number `attempt`: Retry-After if given, else full jitter"""
+    delay = retry_after(error)
+    if delay is not None:
+        return delay
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt))
+
+
+class RateLimiter:
+    """
+    Token bucket limiting the request rate to `rate` per second (bursting up to `burst`) combined
+    with an AIMD limit on requests in flight: each success raises the limit by 1/limit, up to
+    `max_concurrency`, and each throttled request halves it. Share one instance between all the
+    workers using the same quota
+    """
+
+    def __init__(self, rate=DRIVE_QPS, burst=None, max_concurrency=MAX_CONCURRENCY):
+        self.rate = rate
+        self.burst = burst or rate
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+        self.throttled = 0
+        self._tokens = float(self.burst)
+        self._refilled = time.monotonic()
+        self._cond = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def acquire(self, tokens=1):
+        """Block until `tokens` requests may be sent (as one request in flight)"""
+        # a batch larger than the bucket still has to be able to go through eventually
+        tokens = min(tokens, self.burst)
+        with self._cond:
+            while True:
+                self._refill()
+                if self.in_flight < int(self.concurrency) and self._tokens >= tokens:
+                    self._tokens -= tokens
+                    self.in_flight += 1
+                    return
+                if self.in_flight >= int(self.concurrency):
+                    self._cond.wait()
+                else:
+                    self._cond.wait((tokens - self._tokens) / self.rate)
+
+    def release(self, throttled=False):
+        """Mark a request acquired with acquire() finished, adjusting the concurrency limit"""
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                self.concurrency = max(1.0, self.concurrency / 2)
+            else:
+                self.concurrency = min(
+                    self.max_concurrency, self.concurrency + 1 / max(self.concurrency, 1.0)
+                )
+            self._cond.notify_all()
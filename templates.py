@@ -0,0 +1,160 @@
+"""
+Email templates compiled once per campaign. A template is a pair of files, <name>.txt and
+<name>.html, using string.Template placeholders ($name or ${name}). The text file starts with a
+"Subject: ..." line and a blank line. Placeholders available:
+- $recipient, $file_count and $file_links, which differ per recipient
+- $from_email, $owner_target_email, $drive_folder and $resource_key, fixed for the campaign
+"""
+
+import base64
+import binascii
+import html
+import secrets
+from email.header import Header
+from email.utils import formataddr, parseaddr
+from pathlib import Path
+from string import Template as _StringTemplate
+
+# default template, relative to this file
+DEFAULT_TEMPLATE = Path(__file__).parent / "email_templates" / "migration_notice"
+# at most this many file links are listed in a message
+MAX_LINKS = 50
+# base64 body lines, as in RFC 2045 (76 characters per line)
+BASE64_LINE = 57
+
+
+class Template:
+    """
+    A string.Template pre-split into alternating literal and placeholder segments, so rendering is a
+    single join. `escape` is applied to every substituted value not listed in `raw`
+    """
+
+    def __init__(self, text, escape=None, raw=()):
+        self.escape = escape
+        self.raw = frozenset(raw)
+        self.literals = [""]
+        self.names = []
+        position = 0
+        for match in _StringTemplate.pattern.finditer(text):
+            self.literals[-1] += text[position : match.start()]
+            position = match.end()
+            name = match.group("named") or match.group("braced")
+            if match.group("escaped") is not None:
+                self.literals[-1] += "$"
+            elif name:
+                self.names.append(name)
+                self.literals.append("")
+            else:
+                raise ValueError(
+                    f"Invalid placeholder in template at: {text[match.start():][:20]!r}"
+                )
+        self.literals[-1] += text[position:]
+
+    def _value(self, name, values):
+        value = str(values[name])
+        return value if self.escape is None or name in self.raw else self.escape(value)
+
+    def bind(self, **values):
+        """Return a copy with the placeholders in `values` substituted, merging the literals"""
+        bound = Template("", self.escape, self.raw)
+        for name, literal in zip(self.names, self.literals[1:]):
+            if name in values:
+                bound.literals[-1] += self._value(name, values) + literal
+            else:
+                bound.names.append(name)
+                bound.literals.append(literal)
+        bound.literals[0] = self.literals[0] + bound.literals[0]
+        return bound
+
+    def render(self, **values):
+        parts = [self.literals[0]]
+        for name, literal in zip(self.names, self.literals[1:]):
+            parts.append(self._value(name, values))
+            parts.append(literal)
+        return "".join(parts)
+
+
+def _header(name, value):
+    """Encode a header line, using RFC 2047 only for non-ASCII values"""
+    if not value.isascii():
+        value = Header(value, "utf-8").encode()
+    return f"{name}: {value}\r\n".encode("ascii")
+
+
+def _address_header(name, value):
+    """Encode an address header line, using RFC 2047 for non-ASCII display names"""
+    return _header(name, formataddr(parseaddr(value), charset="utf-8"))
+
+
+def _base64_body(text):
+    data = text.encode("utf-8")
+    return b"".join(
+        binascii.b2a_base64(data[i : i + BASE64_LINE], newline=False) + b"\r\n"
+        for i in range(0, len(data), BASE64_LINE)
+    )
+
+
+class EmailTemplate:
+    """
+    Text and HTML templates loaded from `path`.txt and `path`.html and bound to the campaign's
+    constants. message() renders the two bodies for a recipient and assembles the multipart MIME
+    message directly as bytes around headers and boundaries prepared once
+    """
+
+    def __init__(self, path=DEFAULT_TEMPLATE, from_email="", **constants):
+        path = Path(path)
+        text = path.with_suffix(".txt").read_text(encoding="utf-8")
+        first_line, _, text = text.partition("\n")
+        if not first_line.startswith("Subject:"):
+            raise ValueError(f"{path.with_suffix('.txt')} must start with a 'Subject: ...' line")
+        subject = first_line[len("Subject:") :].strip()
+        constants = {**constants, "from_email": from_email}
+
+        self.text = Template(text.lstrip("\n")).bind(**constants)
+        self.html = Template(
+            path.with_suffix(".html").read_text(encoding="utf-8"), html.escape, raw={"file_links"}
+        ).bind(**constants)
+
+        boundary = f"==============={secrets.token_hex(16)}=="
+        self.headers = (
+            _address_header("From", from_email)
+            + _header("Subject", Template(subject).render(**constants))
+            + b"MIME-Version: 1.0\r\n"
+            + f'Content-Type: multipart/alternative; boundary="{boundary}"\r\n'.encode()
+        )
+        part_headers = "Content-Transfer-Encoding: base64\r\n\r\n"
+        self.text_start = (
+            f"\r\n--{boundary}\r\nContent-Type: text/plain; charset=utf-8\r\n{part_headers}"
+        ).encode()
+        self.html_start = (
+            f"--{boundary}\r\nContent-Type: text/html; charset=utf-8\r\n{part_headers}"
+        ).encode()
+        self.end = f"--{boundary}--\r\n".encode()
+
+    def message(self, recipient, links=(), file_count=None):
+        """
+        Return the base64url encoded message for `recipient`, owner of `file_count` files (default
+        len(links)) of which the first MAX_LINKS `links` are listed
+        """
+        links = list(links)
+        file_count = len(links) if file_count is None else file_count
+        shown = links[:MAX_LINKS]
+        more = file_count - len(shown)
+        text_links = "\n".join(shown) + (f"\n... and {more} more" if more > 0 else "")
+        html_links = "".join(
+            f'<li><a href="{html.escape(link)}">{html.escape(link)}</a></li>' for link in shown
+        ) + (f"<li>... and {more} more</li>" if more > 0 else "")
+
+        values = {"recipient": recipient, "file_count": file_count}
+        raw = b"".join(
+            (
+                _address_header("To", recipient),
+                self.headers,
+                self.text_start,
+                _base64_body(self.text.render(**values, file_links=text_links)),
+                self.html_start,
+                _base64_body(self.html.render(**values, file_links=html_links)),
+                self.end,
+            )
+        )
+        return base64.urlsafe_b64encode(raw).decode("ascii")
@@ -0,0 +1,167 @@
+"""
+Shared HTTP transport for googleapiclient: one thread-safe pool of keep-alive connections used by
+every worker's service object, in place of an httplib2.Http (and its own connection) per service.
+Uses requests, or HTTP/2 through httpx if asked to (pip install -r requirements-http2.txt)
+"""
+
+import httplib2
+import requests
+from google_auth_httplib2 import AuthorizedHttp
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import h2  # pylint: disable=unused-import
+    import httpx
+except ImportError:
+    httpx = None
+
+# connections kept open for reuse
+POOL_SIZE = 10
+# seconds to wait for a connection to be established, and for a response to arrive
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 120
+# attempts to open a connection before giving up; nothing was sent yet, so they are always safe
+CONNECT_RETRIES = 3
+
+
+def http2_available():
+    return httpx is not None
+
+
+class HttpPool:
+    """
+    Thread-safe httplib2.Http stand-in backed by a pool of up to `size` keep-alive connections,
+    or HTTP/2 connections if `http2`. Calling it with credentials returns an authorized transport
+    for build(http=...), so an HttpPool is usable as DriveFiles' http_f. Connection failures and
+    timeouts are raised as the builtin ConnectionError and TimeoutError
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        size=POOL_SIZE,
+        connect_timeout=CONNECT_TIMEOUT,
+        read_timeout=READ_TIMEOUT,
+        http2=False,
+    ):
+        self.size = size
+        self.timeout = (connect_timeout, read_timeout)
+        self.http2 = http2
+        if http2 and not http2_available():
+            raise ValueError(
+                "HTTP/2 requires httpx with its http2 extra: pip install -r requirements-http2.txt"
+            )
+        # read by googleapiclient and google_auth_httplib2, as on httplib2.Http
+        self.follow_redirects = True
+        self.redirect_codes = frozenset(httplib2.REDIRECT_CODES)
+        self.connections = {}
+
+        if self.http2:
+            # the client's own http2 and limits arguments only apply to the transport it makes
+            self.client = httpx.Client(
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                transport=httpx.HTTPTransport(
+                    http2=True,
+                    limits=httpx.Limits(max_connections=size, max_keepalive_connections=size),
+                    retries=CONNECT_RETRIES,
+                ),
+                follow_redirects=True,
+            )
+        else:
+            self.client = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=size,
+                pool_block=True,
+                max_retries=Retry(total=CONNECT_RETRIES, read=0, status=0, redirect=None),
+            )
+            self.client.mount("https://", adapter)
+            self.client.mount("http://", adapter)
+
+    def __call__(self, creds):
+        return self if creds is None else AuthorizedHttp(creds, http=self)
+
+    def _send(self, uri, method, body, headers):
+        if self.http2:
+            try:
+                response = self.client.request(method, uri, content=body, headers=headers)
+            except httpx.TimeoutException as e:
+                raise TimeoutError(f"{method} {uri}: {e}") from e
+            except httpx.TransportError as e:
+                raise ConnectionError(f"{method} {uri}: {e}") from e
+            return response.status_code, response.reason_phrase, response.headers, response.content
+
+        try:
+            response = self.client.request(
+                method, uri, data=body, headers=headers, timeout=self.timeout
+            )
+        except requests.Timeout as e:
+            raise TimeoutError(f"{method} {uri}: {e}") from e
+        except requests.ConnectionError as e:
+            raise ConnectionError(f"{method} {uri}: {e}") from e
+        return response.status_code, response.reason, response.headers, response.content
+
+    # pylint: disable=too-many-arguments,unused-argument
+    def request(
+        self, uri, method="GET", body=None, headers=None, redirections=None, connection_type=None
+    ):
+        """httplib2.Http.request: return (httplib2.Response, content)"""
+        status, reason, response_headers, content = self._send(uri, method, body, headers)
+        # the content is decoded already, as httplib2 does
+        info = {
+            k.lower(): v for k, v in response_headers.items() if k.lower() != "content-encoding"
+        }
+        response = httplib2.Response({**info, "status": status})
+        response.reason = reason
+        return response, content
+
+    def close(self):
+        self.client.close()
+
+
+def add_transport_arguments(parser):
+    """Add the connection options used by transport_from_args to argparse `parser`"""
+    parser.add_argument(
+        "--pool-size",
+        help=(
+            "Keep-alive connections shared by all workers (default: the number of workers plus 2,"
+            f" at least {POOL_SIZE})"
+        ),
+        type=int,
+    )
+    parser.add_argument(
+        "--connect-timeout",
+        help=f"Seconds to wait for a connection (default {CONNECT_TIMEOUT})",
+        type=float,
+        default=CONNECT_TIMEOUT,
+    )
+    parser.add_argument(
+        "--read-timeout",
+        help=f"Seconds to wait for a response (default {READ_TIMEOUT})",
+        type=float,
+        default=READ_TIMEOUT,
+    )
+    parser.add_argument(
+        "--http2",
+        help=(
+            "Use HTTP/2, multiplexing requests over fewer connections (needs httpx[http2]:"
+            " pip install -r requirements-http2.txt)"
+        ),
+        action="store_true",
+    )
+
+
+def transport_options(args, workers=1):
+    """Return the HttpPool arguments given by the add_transport_arguments options in `args`"""
+    return {
+        "size": args.pool_size or max(workers + 2, POOL_SIZE),
+        "connect_timeout": args.connect_timeout,
+        "read_timeout": args.read_timeout,
+        "http2": args.http2,
+    }
+
+
+def transport_from_args(args, workers=1):
+    """Return the HttpPool configured by the add_transport_arguments options in `args`"""
+    return HttpPool(**transport_options(args, workers))